@@ -16,75 +16,1682 @@ import collections
 import hashlib
 import hmac
 import time
-import datetime
 import math
 import copy
+import os
+import struct
+import array
+import mmap
+import heapq
+import types
+import zlib
+import threading
+import http.server
 
 from socket import *
-from datetime import datetime, timedelta
 
-# Create socket for udp broadcast
+try:
+    import weeutil.logger
+    import logging
+
+    log = logging.getLogger(__name__)
+    def logdbg(msg):
+        log.debug(msg)
+    def loginf(msg):
+        log.info(msg)
+    def logerr(msg):
+        log.error(msg)
+
+except ImportError:
+    import syslog
+
+
+    def logmsg(level, msg):
+        syslog.syslog(level, 'WLLDriver: %s:' % msg)
+    def logdbg(msg):
+        logmsg(syslog.LOG_DEBUG, msg)
+    def loginf(msg):
+        logmsg(syslog.LOG_INFO, msg)
+    def logerr(msg):
+        logmsg(syslog.LOG_ERR, msg)
+
+
+# Alignment of timestamps on intervals, computed on epoch seconds, so DST changes have no effect. All time zone
+# offsets are multiples of 15 min, so the 900s boundaries of the Health API timer are the same in local time.
+# Longer intervals are aligned on UTC, which is not local time in zones like +5:30, +5:45 or +9:30.
+
+def align_down(timestamp, interval):
+
+    # Start of the interval containing timestamp
+
+    return int(timestamp // interval * interval)
+
+
+def align_up(timestamp, interval):
+
+    # Start of the next interval, even if timestamp is on a boundary
+
+    return int(timestamp // interval * interval + interval)
+
+
+# Layout of columnar files used to keep the raw loop stream :
+#   file header  : magic, version, number of columns, then each column name null-padded
+#   chunk header : number of rows, min timestamp, max timestamp
+#   chunk body   : timestamps delta-encoded (int32) from the min timestamp, then one float64 column per field (NaN if absent)
+
+COLUMNAR_MAGIC = b'WLLC'
+COLUMNAR_VERSION = 1
+COLUMNAR_NAME_SIZE = 24
+COLUMNAR_FILE_HEADER = struct.Struct('<4sHH')
+COLUMNAR_CHUNK_HEADER = struct.Struct('<Iqq')
+COLUMNAR_COLUMNS = ('outTemp', 'outHumidity', 'dewpoint', 'heatindex', 'windchill', 'windSpeed', 'windDir',
+                    'windGust', 'windGustDir', 'rain', 'rainRate', 'UV', 'radiation', 'barometer', 'pressure',
+                    'inTemp', 'inHumidity', 'inDewpoint', 'rxCheckPercent', 'txBatteryStatus',
+                    'consBatteryVoltage', 'supplyVoltage',
+                    'extraTemp1', 'extraTemp2', 'extraTemp3', 'extraTemp4', 'extraTemp5', 'extraTemp6',
+                    'extraTemp7', 'extraHumid1', 'extraHumid2', 'extraHumid3', 'extraHumid4', 'extraHumid5',
+                    'extraHumid6', 'extraHumid7', 'soilTemp1', 'soilTemp2', 'soilTemp3', 'soilTemp4', 'soilMoist1',
+                    'soilMoist2', 'soilMoist3', 'soilMoist4', 'leafWet1', 'leafWet2')
+
+
+def columnar_file_name(path, timestamp):
+
+    # One file per UTC day
+
+    return os.path.join(path, time.strftime('wll_%Y%m%d.col', time.gmtime(timestamp)))
+
+
+def columnar_to_le(values):
+
+    # Columns are always stored little-endian
+
+    if sys.byteorder != 'little':
+        values.byteswap()
+
+    return values
+
+
+class WLLColumnarWriter():
+
+    def __init__(self, path, chunk_size, flush_interval):
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.file_name = None
+        self.columns = None
+        self.buffer_ts = []
+        self.buffer_columns = None
+        self.last_flush = time.time()
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        logdbg("Columnar store path : {}".format(self.path))
+
+    def open_file(self, file_name):
+
+        # Read columns of an existing file to keep appending with the same layout, else create header
+
+        columns = None
+
+        if os.path.isfile(file_name) and os.path.getsize(file_name) >= COLUMNAR_FILE_HEADER.size:
+            with open(file_name, 'r+b') as f:
+                magic, version, ncols = COLUMNAR_FILE_HEADER.unpack(f.read(COLUMNAR_FILE_HEADER.size))
+
+                if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+                    raise weewx.WeeWxIOError('Columnar file {} has an invalid header'.format(file_name))
+
+                names = f.read(COLUMNAR_NAME_SIZE * ncols)
+
+                if len(names) == COLUMNAR_NAME_SIZE * ncols:
+                    columns = tuple(names[i:i + COLUMNAR_NAME_SIZE].rstrip(b'\0').decode('ascii')
+                                    for i in range(0, len(names), COLUMNAR_NAME_SIZE))
+                    self.truncate_torn_chunk(f, file_name, ncols)
+
+        if columns is None:
+            columns = COLUMNAR_COLUMNS
+
+            with open(file_name, 'wb') as f:
+                f.write(COLUMNAR_FILE_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(columns)))
+                for name in columns:
+                    f.write(name.encode('ascii').ljust(COLUMNAR_NAME_SIZE, b'\0'))
+
+        self.file_name = file_name
+        self.columns = columns
+        self.buffer_columns = dict((name, array.array('d')) for name in self.columns)
+
+    @staticmethod
+    def truncate_torn_chunk(f, file_name, ncols):
+
+        # A crash during write leaves the last chunk incomplete, new chunks appended after it would be read
+        # as part of it. Walk chunk headers and cut the file at the end of the last complete chunk.
+
+        size = os.fstat(f.fileno()).st_size
+        offset = f.tell()
+
+        while offset + COLUMNAR_CHUNK_HEADER.size <= size:
+            f.seek(offset)
+            nrows, first_ts, last_ts = COLUMNAR_CHUNK_HEADER.unpack(f.read(COLUMNAR_CHUNK_HEADER.size))
+            chunk_end = offset + COLUMNAR_CHUNK_HEADER.size + nrows * 4 + nrows * 8 * ncols
+
+            if chunk_end > size:
+                break
+
+            offset = chunk_end
+
+        if offset < size:
+            loginf("Columnar file {} has a truncated chunk, {} bytes removed".format(file_name, size - offset))
+            f.truncate(offset)
+
+    def append(self, packet):
+
+        # Append one decoded loop packet, fields outside the file layout are ignored
+
+        if packet is None or packet.get('dateTime') is None:
+            return
+
+        timestamp = int(packet['dateTime'])
+        file_name = columnar_file_name(self.path, timestamp)
+
+        if file_name != self.file_name:
+            self.flush()
+            self.open_file(file_name)
+
+        self.buffer_ts.append(timestamp)
+
+        for name in self.columns:
+            value = packet.get(name)
+            self.buffer_columns[name].append(float(value) if value is not None else float('nan'))
+
+        if len(self.buffer_ts) >= self.chunk_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+
+        # Write buffered rows as one chunk
+
+        self.last_flush = time.time()
+
+        if not self.buffer_ts:
+            return
+
+        # First delta is taken from the min timestamp stored in the chunk header
+        first_ts = min(self.buffer_ts)
+        deltas = array.array('i', [self.buffer_ts[0] - first_ts])
+        for index in range(1, len(self.buffer_ts)):
+            deltas.append(self.buffer_ts[index] - self.buffer_ts[index - 1])
+
+        with open(self.file_name, 'ab') as f:
+            # Packets are not sorted by time, header keeps min and max to skip chunks when reading
+            f.write(COLUMNAR_CHUNK_HEADER.pack(len(self.buffer_ts), first_ts, max(self.buffer_ts)))
+            f.write(columnar_to_le(deltas).tobytes())
+            for name in self.columns:
+                f.write(columnar_to_le(self.buffer_columns[name]).tobytes())
+
+        logdbg("Columnar chunk of {} rows written to {}".format(len(self.buffer_ts), self.file_name))
+
+        self.buffer_ts = []
+        self.buffer_columns = dict((name, array.array('d')) for name in self.columns)
+
+    def close(self):
+
+        self.flush()
+
+
+class WLLColumnarReader():
+
+    def __init__(self, path):
+
+        self.path = path
+
+    def read_file(self, file_name, start_timestamp, end_timestamp, columns):
+
+        # Walk chunk headers through mmap and only decode chunks and columns overlapping the range
+
+        if not os.path.isfile(file_name) or os.path.getsize(file_name) <= COLUMNAR_FILE_HEADER.size:
+            return
+
+        with open(file_name, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                magic, version, ncols = COLUMNAR_FILE_HEADER.unpack_from(mm, 0)
+
+                if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+                    raise weewx.WeeWxIOError('Columnar file {} has an invalid header'.format(file_name))
+
+                offset = COLUMNAR_FILE_HEADER.size
+                file_columns = []
+                for index in range(ncols):
+                    file_columns.append(mm[offset:offset + COLUMNAR_NAME_SIZE].rstrip(b'\0').decode('ascii'))
+                    offset += COLUMNAR_NAME_SIZE
+
+                selected = [(index, name) for index, name in enumerate(file_columns)
+                            if columns is None or name in columns]
+
+                while offset + COLUMNAR_CHUNK_HEADER.size <= len(mm):
+                    nrows, first_ts, last_ts = COLUMNAR_CHUNK_HEADER.unpack_from(mm, offset)
+                    body = offset + COLUMNAR_CHUNK_HEADER.size
+                    chunk_end = body + nrows * 4 + nrows * 8 * ncols
+
+                    # Last chunk truncated by a crash during write
+                    if chunk_end > len(mm):
+                        logdbg("Columnar file {} has a truncated chunk, stop reading".format(file_name))
+                        break
+
+                    if first_ts <= end_timestamp and last_ts >= start_timestamp:
+                        deltas = array.array('i')
+                        deltas.frombytes(mm[body:body + nrows * 4])
+                        columnar_to_le(deltas)
+
+                        values = {}
+                        for index, name in selected:
+                            column_offset = body + nrows * 4 + nrows * 8 * index
+                            values[name] = array.array('d')
+                            values[name].frombytes(mm[column_offset:column_offset + nrows * 8])
+                            columnar_to_le(values[name])
+
+                        timestamp = first_ts
+                        for row in range(nrows):
+                            timestamp += deltas[row]
+
+                            if start_timestamp <= timestamp <= end_timestamp:
+                                packet = {'dateTime': timestamp, 'usUnits': weewx.US}
+                                for index, name in selected:
+                                    value = values[name][row]
+                                    if not math.isnan(value):
+                                        packet[name] = value
+
+                                yield packet
+
+                    offset = chunk_end
+
+            finally:
+                mm.close()
+
+    def iter_range(self, start_timestamp, end_timestamp, columns=None):
+
+        # Iterate packets between two timestamps, file by file without loading whole files. Only existing files
+        # are opened, names sort by day.
+
+        if not os.path.isdir(self.path):
+            return
+
+        first_file = columnar_file_name(self.path, max(start_timestamp, 0))
+        last_file = columnar_file_name(self.path, min(end_timestamp, 253402300799))
+
+        for file_name in sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                                if name.startswith('wll_') and name.endswith('.col')):
+            if first_file <= file_name <= last_file:
+                for _packet in self.read_file(file_name, start_timestamp, end_timestamp, columns):
+                    yield _packet
+
+
+class WLLPacketFilter():
+
+    def __init__(self, history_size, reorder_window, clock=time.time):
+
+        # Keep the last timestamps seen by source to drop duplicates, and hold packets during
+        # reorder_window seconds to release them sorted by dateTime
+
+        self.history_size = history_size
+        self.reorder_window = reorder_window
+        self.clock = clock
+        self.history = {}
+        self.pending = []
+        self.sequence = 0
+        self.newest_timestamp = None
+        self.last_released = None
+        self.suppressed = 0
+        self.reordered = 0
+        self.late = 0
+
+    def is_duplicate(self, source, timestamp):
+
+        if self.history_size <= 0:
+            return False
+
+        if source not in self.history:
+            self.history[source] = (collections.deque(), set())
+
+        order, seen = self.history[source]
+
+        if timestamp in seen:
+            return True
+
+        order.append(timestamp)
+        seen.add(timestamp)
+
+        if len(order) > self.history_size:
+            seen.discard(order.popleft())
+
+        return False
+
+    def push(self, source, packet):
+
+        # Return the packets ready to be sent to Weewx after adding this one
+
+        timestamp = packet.get('dateTime')
+
+        if timestamp is None:
+            return [packet] + self.pop_ready()
+
+        if self.is_duplicate(source, timestamp):
+            self.suppressed += 1
+            logdbg("Duplicate packet from {} suppressed for timestamp : {}".format(source, timestamp))
+            return self.pop_ready()
+
+        if self.newest_timestamp is not None and timestamp < self.newest_timestamp:
+            if self.last_released is None or timestamp >= self.last_released:
+                if self.reorder_window > 0:
+                    self.reordered += 1
+                    logdbg("Packet from {} reordered for timestamp : {}".format(source, timestamp))
+                else:
+                    self.late += 1
+            else:
+                self.late += 1
+                logdbg("Packet from {} arrived too late to be reordered for timestamp : {}".format(source,
+                                                                                                 timestamp))
+        else:
+            self.newest_timestamp = timestamp
+
+        heapq.heappush(self.pending, (timestamp, self.sequence, self.clock(), packet))
+        self.sequence += 1
+
+        return self.pop_ready()
+
+    def pop_ready(self, flush=False):
+
+        # Release packets held more than reorder_window, oldest dateTime first
+
+        ready = []
+        now = self.clock()
+
+        while self.pending and (flush or self.pending[0][2] + self.reorder_window <= now):
+            timestamp, sequence, arrival, packet = heapq.heappop(self.pending)
+
+            if self.last_released is None or timestamp > self.last_released:
+                self.last_released = timestamp
+
+            ready.append(packet)
+
+        return ready
+
+    def stats(self):
+
+        return {'suppressed': self.suppressed,
+                'reordered': self.reordered,
+                'late': self.late,
+                }
+
+
+class WLLRainLedger():
+
+    def __init__(self, state_file):
+
+        # Keep the last rainfall_daily counter of the WLL with its day and timestamp, shared by UDP and HTTP
+        # packets. The counter is reset at midnight of the WLL, the day is taken in local time of the host which
+        # must be the time zone of the station. The ledger is saved in state_file so tips fallen while Weewx
+        # was stopped are not lost.
+
+        self.state_file = state_file
+        self.counter = None
+        self.day = None
+        self.timestamp = None
+        self.backfill_end = None
+
+        self.load()
+
+    def load(self):
+
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
+
+        try:
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+
+            self.counter = state.get('counter')
+            self.day = state.get('day')
+            self.timestamp = state.get('timestamp')
+            logdbg("Rain ledger loaded from {} : {} on {} at {}".format(self.state_file, self.counter, self.day,
+                                                                       self.timestamp))
+
+        except (OSError, ValueError) as error:
+            logerr("Unable to load rain ledger from {} : {}".format(self.state_file, error))
+
+    def save(self):
+
+        # Write to a temporary file then rename it, so the state is never half written
+
+        if not self.state_file:
+            return
+
+        try:
+            state_path = os.path.dirname(self.state_file)
+            if state_path and not os.path.isdir(state_path):
+                os.makedirs(state_path)
+
+            tmp_file = self.state_file + '.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'counter': self.counter, 'day': self.day, 'timestamp': self.timestamp}, f)
+            os.replace(tmp_file, self.state_file)
+
+        except OSError as error:
+            logerr("Unable to save rain ledger to {} : {}".format(self.state_file, error))
+
+    def set_backfill_end(self, timestamp):
+
+        # Rain until timestamp is already in archive records requested to Weatherlink.com at startup
+
+        if self.backfill_end is None or timestamp > self.backfill_end:
+            self.backfill_end = timestamp
+
+    def update(self, timestamp, rainFall_Daily, source):
+
+        # Return the number of new tips since the last counter known
+
+        day = time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+        if self.backfill_end is not None and timestamp <= self.backfill_end:
+            # Already counted by archive records of Weatherlink.com
+            return 0
+
+        if self.counter is None or (self.backfill_end is not None and self.timestamp < self.backfill_end):
+            # Nothing known or state older than the archive records, only seed the ledger
+            logdbg("Rain ledger seeded by {} : {} on {}".format(source, rainFall_Daily, day))
+            self.counter = rainFall_Daily
+            self.day = day
+            self.timestamp = timestamp
+            self.save()
+            return 0
+
+        if timestamp < self.timestamp:
+            # Packet older than the last counter, already counted
+            return 0
+
+        if day != self.day:
+            # New day, the whole counter fell since the reset of the WLL at midnight
+            logdbg("Rain ledger rollover to {} seen by {} : {} -> {}".format(day, source, self.counter,
+                                                                            rainFall_Daily))
+            new_tips = rainFall_Daily
+
+        elif rainFall_Daily < self.counter:
+            # Counter reset by the WLL in the same day (reboot), tips since the reset are new
+            logdbg("Rainfall_Daily reset, seen by {} : {} -> {}".format(source, self.counter, rainFall_Daily))
+            new_tips = rainFall_Daily
+
+        else:
+            new_tips = rainFall_Daily - self.counter
+
+        self.timestamp = timestamp
+
+        if rainFall_Daily != self.counter or day != self.day:
+            self.counter = rainFall_Daily
+            self.day = day
+            self.save()
+
+        return new_tips
+
+
+class WLLNullSpanContext():
+
+    # Span used when the packet is not sampled
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        return False
+
+
+WLLNullSpan = WLLNullSpanContext()
+
+
+class WLLTraceSpan():
+
+    def __init__(self, tracer, name):
+
+        self.tracer = tracer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.tracer.add_event(self.name, self.start, time.time())
+        return False
+
+
+class WLLTracer():
+
+    def __init__(self, trace_file, trace_sample, profile_file, profile_every):
+
+        # Trace 1 packet each trace_sample in trace_file with Chrome trace event format (JSON array without
+        # closing bracket, allowed by the format), open it with chrome://tracing or ui.perfetto.dev.
+        # Profile decoder with cProfile and dump stats each profile_every packets in profile_file.
+
+        self.trace_file = trace_file
+        self.trace_sample = trace_sample
+        self.profile_file = profile_file
+        self.profile_every = profile_every
+        self.packet_count = 0
+        self.sampled = False
+        self.events = []
+        self.pid = os.getpid()
+        self.profiler = None
+        self.profiled_packets = 0
+        self.packet_thread = None
+
+        if self.trace_file:
+            if not os.path.isfile(self.trace_file) or os.path.getsize(self.trace_file) == 0:
+                with open(self.trace_file, 'w') as f:
+                    f.write('[\n')
+
+            logdbg("Trace 1 packet each {} in {}".format(self.trace_sample, self.trace_file))
+
+        if self.profile_file:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            logdbg("Profile decoder each {} packets in {}".format(self.profile_every, self.profile_file))
+
+    def start_packet(self):
+
+        self.packet_count += 1
+        self.sampled = bool(self.trace_file) and self.trace_sample > 0 and \
+            self.packet_count % self.trace_sample == 0
+        self.events = []
+        self.packet_thread = threading.get_ident()
+
+    def span(self, name):
+
+        # Requests made by the cache proxy thread are not part of the packet traced by the driver
+
+        if self.sampled and threading.get_ident() == self.packet_thread:
+            return WLLTraceSpan(self, name)
+
+        return WLLNullSpan
+
+    def add_event(self, name, start, end, args=None):
+
+        event = {'name': name, 'cat': 'WLLDriver', 'ph': 'X', 'pid': self.pid, 'tid': 1,
+                 'ts': int(start * 1000000), 'dur': int((end - start) * 1000000)}
+
+        if args is not None:
+            event['args'] = args
+
+        self.events.append(event)
+
+    def yield_packet(self, packet, type_of_packet):
+
+        # Add span from WLL timestamp to the yield on its own row
+
+        if self.sampled and packet.get('dateTime') is not None:
+            self.add_event('wll_to_yield', packet['dateTime'], time.time(), {'type_of_packet': type_of_packet})
+            self.events[-1]['tid'] = 0
+
+    def end_packet(self):
+
+        # Write all spans of the packet
+
+        if not self.sampled:
+            return
+
+        try:
+            with open(self.trace_file, 'a') as f:
+                for event in self.events:
+                    f.write(json.dumps(event) + ',\n')
+
+        except OSError as error:
+            logerr("Unable to write trace to {} : {}".format(self.trace_file, error))
+
+        self.events = []
+
+    def profile_start(self):
+
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def profile_stop(self):
+
+        if self.profiler is None:
+            return
+
+        self.profiler.disable()
+        self.profiled_packets += 1
+
+        if self.profiled_packets % self.profile_every == 0:
+            self.profiler.dump_stats(self.profile_file)
+            logdbg("Profile stats of {} packets dumped to {}".format(self.profiled_packets, self.profile_file))
+
+
+# Sensor type IDs of Weatherlink.com accepted for each sensor class of device_id
+
+WL_ISS_SENSOR_TYPES = frozenset({23, 24, 27, 28, 43, 44, 45, 46, 48, 49, 50,
+                                 51, 76, 77, 78, 79, 80, 81, 82, 83})
+
+WL_SENSOR_TYPES = {'iss': WL_ISS_SENSOR_TYPES,
+                   'extraTemp': frozenset({55}),
+                   'extraHumid': frozenset({55}),
+                   'extraTempHum': frozenset({55}),
+                   'extra_Anenometer': WL_ISS_SENSOR_TYPES,
+                   'extra_RainGauge': WL_ISS_SENSOR_TYPES,
+                   'soilLeaf': frozenset({56}),
+                   }
+
+# Capabilities of each sensor class, they select the field maps of the sensor decoders below
+
+WLL_CAPABILITIES = {'iss': frozenset({'temp', 'hum', 'iss', 'wind', 'rain'}),
+                    'extraTemp': frozenset({'temp'}),
+                    'extraHumid': frozenset({'hum'}),
+                    'extraTempHum': frozenset({'temp', 'hum'}),
+                    'extra_Anenometer': frozenset({'wind'}),
+                    'extra_RainGauge': frozenset({'rain'}),
+                    'soilLeaf': frozenset({'soil_leaf'}),
+                    }
+
+WLL_SOIL_LEAF_FIELDS = ('soilTemp1', 'soilTemp2', 'soilTemp3', 'soilTemp4', 'soilMoist1', 'soilMoist2',
+                        'soilMoist3', 'soilMoist4', 'leafWet1', 'leafWet2')
+
+WLLDevice = collections.namedtuple('WLLDevice', ['txid', 'name', 'sensor_class', 'number', 'temp_field',
+                                                 'hum_field', 'fields', 'is_iss', 'capabilities', 'sensor_types'])
+
+
+class WLLDeviceRegistry():
+
+    def __init__(self, device_id):
+
+        # Parse and check device_id (ex : 1:iss-2:extraTemp1) once at startup, decoders only read the result
+
+        devices = []
+        by_txid = {}
+        fields = {}
+
+        for entry in device_id.split('-'):
+            txid, separator, name = entry.strip().partition(':')
+            name = name.strip()
+
+            if not separator or not txid.strip().isdigit():
+                raise weewx.ViolatedPrecondition("Invalid entry '{}' in device_id '{}', expected "
+                                                 "<txid>:<sensor>".format(entry, device_id))
+
+            txid = int(txid)
+
+            if not 1 <= txid <= 8:
+                raise weewx.ViolatedPrecondition("Invalid txid {} in device_id '{}', WLL transmitter ID is "
+                                                 "between 1 and 8".format(txid, device_id))
+
+            if txid in by_txid:
+                raise weewx.ViolatedPrecondition("txid {} is set twice in device_id '{}'".format(txid, device_id))
+
+            device = self.build_device(txid, name, device_id)
+            devices.append(device)
+            by_txid[txid] = device
+
+        # An extra_Anenometer or extra_RainGauge replaces the wind or the rain of the ISS
+
+        for capability, sensor_class in (('wind', 'extra_Anenometer'), ('rain', 'extra_RainGauge')):
+            if any(device.sensor_class == sensor_class for device in devices):
+                for index, device in enumerate(devices):
+                    if device.is_iss:
+                        devices[index] = device._replace(capabilities=device.capabilities - {capability})
+                        by_txid[device.txid] = devices[index]
+
+        # Each weewx field, wind and rain counters are written by one device only
+
+        for device in devices:
+            for field in device.fields + tuple(sorted(device.capabilities & {'wind', 'rain'})):
+                if field in fields:
+                    raise weewx.ViolatedPrecondition("{} is set by txid {} and {} in device_id '{}'".format(
+                        field, fields[field], device.txid, device_id))
+                fields[field] = device.txid
+
+        self.devices = tuple(devices)
+        self.by_txid = types.MappingProxyType(by_txid)
+        self.sensor_types = frozenset().union(*(device.sensor_types for device in self.devices))
+
+        logdbg("Devices : {}".format(self.devices))
+
+    @staticmethod
+    def build_device(txid, name, device_id):
+
+        if name in ('iss', 'iss+'):
+            return WLLDevice(txid, name, 'iss', None, 'outTemp', 'outHumidity', ('outTemp', 'outHumidity'), True,
+                             WLL_CAPABILITIES['iss'], WL_SENSOR_TYPES['iss'])
+
+        if name in ('extra_Anenometer', 'extra_RainGauge'):
+            return WLLDevice(txid, name, name, None, None, None, (), False, WLL_CAPABILITIES[name],
+                             WL_SENSOR_TYPES[name])
+
+        if name == 'soilLeaf':
+            return WLLDevice(txid, name, name, None, None, None, WLL_SOIL_LEAF_FIELDS, False,
+                             WLL_CAPABILITIES[name], WL_SENSOR_TYPES[name])
+
+        number = name[len('extraTempHum'):]
+
+        if name.startswith('extraTempHum') and number.isdigit() and int(number) >= 1:
+            # Temperature and humidity of the same sensor, needed to compute derived quantities
+            return WLLDevice(txid, name, 'extraTempHum', int(number), 'extraTemp' + number, 'extraHumid' + number,
+                             ('extraTemp' + number, 'extraHumid' + number), False, WLL_CAPABILITIES['extraTempHum'],
+                             WL_SENSOR_TYPES['extraTempHum'])
+
+        for sensor_class in ('extraTemp', 'extraHumid'):
+            number = name[len(sensor_class):]
+
+            if name.startswith(sensor_class) and number.isdigit() and int(number) >= 1:
+                return WLLDevice(txid, name, sensor_class, int(number),
+                                 name if sensor_class == 'extraTemp' else None,
+                                 name if sensor_class == 'extraHumid' else None,
+                                 (name,), False, WLL_CAPABILITIES[sensor_class], WL_SENSOR_TYPES[sensor_class])
+
+        raise weewx.ViolatedPrecondition("Unknown sensor '{}' for txid {} in device_id '{}', use iss, iss+, "
+                                         "extraTemp<n>, extraHumid<n>, extraTempHum<n>, extra_Anenometer, "
+                                         "extra_RainGauge or soilLeaf".format(name, txid, device_id))
+
+
+# Sensor decoders. A decoder declares for each capability a field map of (source key, weewx field, divisor,
+# rain_size) : the value is divided by divisor if set, and only taken if the rain_size of the block is the same
+# when set. For decoders per device, a weewx field None means the temperature or humidity field of the device,
+# and with rain_counter the 'rain' capability fills the rain counters used by calculate_rain.
+# Decoders without device use the capability None. Adding a sensor costs an entry in these tables.
+
+WLLSensorDecoder = collections.namedtuple('WLLSensorDecoder', ['name', 'per_device', 'rain_counter', 'field_map'])
+
+WLL_ISS_LIVE_FIELDS = {'temp': (('temp', None, None, None),),
+                       'hum': (('hum', None, None, None),),
+                       'iss': (('dew_point', 'dewpoint', None, None),
+                               ('heat_index', 'heatindex', None, None),
+                               ('wind_chill', 'windchill', None, None),
+                               ('trans_battery_flag', 'txBatteryStatus', None, None),
+                               ('uv_index', 'UV', None, None),
+                               ('solar_rad', 'radiation', None, None)),
+                       'wind': (('wind_speed_last', 'windSpeed', None, None),
+                                ('wind_dir_last', 'windDir', None, None)),
+                       'wind_gust_10m': (('wind_speed_hi_last_10_min', 'windGust', None, None),
+                                         ('wind_dir_at_hi_speed_last_10_min', 'windGustDir', None, None)),
+                       'wind_gust_2m': (('wind_speed_hi_last_2_min', 'windGust', None, None),
+                                        ('wind_dir_at_hi_speed_last_2_min', 'windGustDir', None, None)),
+                       'rain': (('rain_rate_last', 'rainRate', None, None),
+                                ('rainfall_daily', 'rainFall_Daily', None, None),
+                                ('rain_size', 'rainSize', None, None)),
+                       }
+
+# Decoders of current_conditions, by data_structure_type
+
+WLL_LIVE_SENSORS = {1: WLLSensorDecoder('ISS', True, True, WLL_ISS_LIVE_FIELDS),
+                    2: WLLSensorDecoder('Soil/Leaf', True, False, {
+                        'soil_leaf': (('temp_1', 'soilTemp1', None, None),
+                                      ('temp_2', 'soilTemp2', None, None),
+                                      ('temp_3', 'soilTemp3', None, None),
+                                      ('temp_4', 'soilTemp4', None, None),
+                                      ('moist_soil_1', 'soilMoist1', None, None),
+                                      ('moist_soil_2', 'soilMoist2', None, None),
+                                      ('moist_soil_3', 'soilMoist3', None, None),
+                                      ('moist_soil_4', 'soilMoist4', None, None),
+                                      ('wet_leaf_1', 'leafWet1', None, None),
+                                      ('wet_leaf_2', 'leafWet2', None, None))}),
+                    3: WLLSensorDecoder('Barometer', False, False, {
+                        None: (('bar_sea_level', 'barometer', None, None),
+                               ('bar_absolute', 'pressure', None, None))}),
+                    4: WLLSensorDecoder('Inside', False, False, {
+                        None: (('temp_in', 'inTemp', None, None),
+                               ('hum_in', 'inHumidity', None, None),
+                               ('dew_point_in', 'inDewpoint', None, None))}),
+                    }
+
+# Decoders of UDP realtime broadcast, by data_structure_type
+
+WLL_UDP_SENSORS = {1: WLLSensorDecoder('ISS', True, True, dict((capability, WLL_ISS_LIVE_FIELDS[capability])
+                                                               for capability in ('wind', 'wind_gust_10m',
+                                                                                  'rain'))),
+                   }
+
+# Decoders of Weatherlink.com archive, by sensor_type
+
+WL_ISS_HISTORIC_SENSOR = WLLSensorDecoder('ISS', True, False, {
+    'temp': (('temp_last', None, None, None),),
+    'hum': (('hum_last', None, None, None),),
+    'iss': (('reception', 'rxCheckPercent', None, None),
+            ('dew_point_last', 'dewpoint', None, None),
+            ('heat_index_last', 'heatindex', None, None),
+            ('wind_chill_last', 'windchill', None, None),
+            ('uv_index_avg', 'UV', None, None),
+            ('solar_rad_avg', 'radiation', None, None)),
+    'wind': (('wind_speed_avg', 'windSpeed', None, None),
+             ('wind_dir_of_prevail', 'windDir', None, None),
+             ('wind_speed_hi', 'windGust', None, None),
+             ('wind_speed_hi_dir', 'windGustDir', None, None)),
+    'rain': (('rain_rate_hi_in', 'rainRate', None, 1),
+             ('rainfall_in', 'rain', None, 1),
+             ('rain_rate_hi_mm', 'rainRate', 25.4, 2),
+             ('rainfall_mm', 'rain', 25.4, 2)),
+})
+
+WL_HISTORIC_SENSORS = dict((sensor_type, WL_ISS_HISTORIC_SENSOR) for sensor_type in WL_ISS_SENSOR_TYPES)
+WL_HISTORIC_SENSORS.update({
+    55: WLLSensorDecoder('Temp/Hum', True, False, {'temp': (('temp_last', None, None, None),),
+                                                   'hum': (('hum_last', None, None, None),)}),
+    56: WLLSensorDecoder('Soil/Leaf', True, False, {
+        'soil_leaf': (('temp_last_1', 'soilTemp1', None, None),
+                      ('temp_last_2', 'soilTemp2', None, None),
+                      ('temp_last_3', 'soilTemp3', None, None),
+                      ('temp_last_4', 'soilTemp4', None, None),
+                      ('moist_soil_last_1', 'soilMoist1', None, None),
+                      ('moist_soil_last_2', 'soilMoist2', None, None),
+                      ('moist_soil_last_3', 'soilMoist3', None, None),
+                      ('moist_soil_last_4', 'soilMoist4', None, None),
+                      ('wet_leaf_last_1', 'leafWet1', None, None),
+                      ('wet_leaf_last_2', 'leafWet2', None, None))}),
+    242: WLLSensorDecoder('Barometer', False, False, {None: (('bar_sea_level', 'barometer', None, None),
+                                                             ('bar_absolute', 'pressure', None, None))}),
+    243: WLLSensorDecoder('Inside', False, False, {None: (('temp_in_last', 'inTemp', None, None),
+                                                          ('hum_in_last', 'inHumidity', None, None),
+                                                          ('dew_point_in', 'inDewpoint', None, None))}),
+    323: WLLSensorDecoder('AirLink', False, False, {None: (('pm_1_avg', 'pm1_0', None, None),
+                                                           ('pm_2p5_avg', 'pm2_5', None, None),
+                                                           ('pm_10_avg', 'pm10_0', None, None))}),
+    504: WLLSensorDecoder('WLL Health', False, False, {None: (('battery_voltage', 'consBatteryVoltage', 1000, None),
+                                                              ('input_voltage', 'supplyVoltage', 1000, None))}),
+})
+
+
+class WLLSensorRegistry():
+
+    def __init__(self, device_registry, wind_gust_2m_enable):
+
+        # Resolve the field maps of each decoder for the configured devices once at startup. Each table gives
+        # for a key (data_structure_type or sensor_type) : (per device, {txid or None : fields to copy}).
+
+        live_gust = 'wind_gust_2m' if wind_gust_2m_enable == 1 else 'wind_gust_10m'
+
+        self.live = self.resolve(WLL_LIVE_SENSORS, device_registry, live_gust, False)
+        self.udp = self.resolve(WLL_UDP_SENSORS, device_registry, 'wind_gust_10m', False)
+        self.historic = self.resolve(WL_HISTORIC_SENSORS, device_registry, None, True)
+
+    @staticmethod
+    def resolve(decoders, device_registry, gust_capability, by_sensor_type):
+
+        table = {}
+
+        for key, decoder in decoders.items():
+            entries = {}
+
+            if decoder.per_device:
+                for device in device_registry.devices:
+                    if by_sensor_type and key not in device.sensor_types:
+                        continue
+
+                    capabilities = set(device.capabilities)
+                    if 'wind' in device.capabilities and gust_capability is not None:
+                        capabilities.add(gust_capability)
+
+                    fields = []
+                    for capability in sorted(capabilities):
+                        for source, target, divisor, rain_size in decoder.field_map.get(capability, ()):
+                            if target is None:
+                                target = device.temp_field if capability == 'temp' else device.hum_field
+                            fields.append((source, target, divisor, rain_size,
+                                           decoder.rain_counter and capability == 'rain'))
+
+                    if fields:
+                        entries[device.txid] = tuple(fields)
+
+                # Rain counters of all blocks go to the same rain_data and ledger, they must come from one gauge
+                rain_devices = [txid for txid, fields in entries.items() if any(field[4] for field in fields)]
+                if len(rain_devices) > 1:
+                    raise weewx.ViolatedPrecondition("Rain counters of {} are decoded from txid {}, only one rain "
+                                                     "gauge is allowed".format(decoder.name, rain_devices))
+
+            else:
+                entries[None] = tuple((source, target, divisor, rain_size, False)
+                                      for source, target, divisor, rain_size in decoder.field_map[None])
+
+            if entries:
+                table[key] = (decoder.per_device, types.MappingProxyType(entries))
+
+        return types.MappingProxyType(table)
+
+    @staticmethod
+    def decode(table, key, s, txid_key, packet, rain_data):
+
+        # Copy fields of one block to packet, or to rain_data for rain counters
+
+        decoder = table.get(key)
+
+        if decoder is None:
+            return
+
+        fields = decoder[1].get(s.get(txid_key) if decoder[0] else None)
+
+        if fields is None:
+            return
+
+        for source, target, divisor, rain_size, to_rain in fields:
+            if source in s:
+                if rain_size is not None and s.get('rain_size') != rain_size:
+                    continue
+
+                value = s[source]
+
+                if divisor is not None and value is not None:
+                    value = value / divisor
+
+                if to_rain:
+                    rain_data[target] = value
+                else:
+                    packet[target] = value
+
+
+# Constants of derived quantities, computed once
+
+DERIVED_MAGNUS_B = 17.27
+DERIVED_MAGNUS_C = 237.7
+DERIVED_HUMIDEX_K = 5417.7530
+DERIVED_HUMIDEX_T0 = 1 / 273.16
+DERIVED_MPH_TO_MS = 0.44704
+DERIVED_F_TO_C = 5.0 / 9.0
+DERIVED_C_TO_F = 9.0 / 5.0
+
+
+def derived_dewpoint_c(temp_c, hum):
+
+    gamma = math.log(hum / 100.0) + DERIVED_MAGNUS_B * temp_c / (DERIVED_MAGNUS_C + temp_c)
+
+    return DERIVED_MAGNUS_C * gamma / (DERIVED_MAGNUS_B - gamma)
+
+
+def derived_heatindex_f(temp_f, hum):
+
+    # Heat index from NWS (Rothfusz regression with adjustments), not defined below 40F
+
+    if temp_f <= 40.0:
+        return temp_f
+
+    heatindex = 0.5 * (temp_f + 61.0 + (temp_f - 68.0) * 1.2 + hum * 0.094)
+
+    if (heatindex + temp_f) / 2.0 < 80.0:
+        return heatindex
+
+    heatindex = -42.379 + 2.04901523 * temp_f + 10.14333127 * hum - 0.22475541 * temp_f * hum \
+        - 6.83783e-3 * temp_f * temp_f - 5.481717e-2 * hum * hum + 1.22874e-3 * temp_f * temp_f * hum \
+        + 8.5282e-4 * temp_f * hum * hum - 1.99e-6 * temp_f * temp_f * hum * hum
+
+    if hum < 13.0 and 80.0 <= temp_f <= 112.0:
+        heatindex -= ((13.0 - hum) / 4.0) * math.sqrt((17.0 - abs(temp_f - 95.0)) / 17.0)
+    elif hum > 85.0 and 80.0 <= temp_f <= 87.0:
+        heatindex += ((hum - 85.0) / 10.0) * ((87.0 - temp_f) / 5.0)
+
+    return heatindex
+
+
+def derived_windchill_f(temp_f, wind_mph):
+
+    if temp_f > 50.0 or wind_mph < 3.0:
+        return temp_f
+
+    wind_power = wind_mph ** 0.16
+
+    return 35.74 + 0.6215 * temp_f - 35.75 * wind_power + 0.4275 * temp_f * wind_power
+
+
+def derived_values(temp_f, hum, wind_mph):
+
+    # Compute derived quantities in US units from temperature (F), humidity (%) and wind speed (mph)
+
+    temp_c = (temp_f - 32.0) * DERIVED_F_TO_C
+    result = {'heatindex': derived_heatindex_f(temp_f, hum)}
+
+    if hum > 0:
+        dewpoint_c = derived_dewpoint_c(temp_c, hum)
+        result['dewpoint'] = dewpoint_c * DERIVED_C_TO_F + 32.0
+
+        humidex_c = temp_c + 0.5555 * (6.11 * math.exp(DERIVED_HUMIDEX_K * (DERIVED_HUMIDEX_T0 -
+                                                                            1 / (273.15 + dewpoint_c))) - 10.0)
+        result['humidex'] = max(humidex_c, temp_c) * DERIVED_C_TO_F + 32.0
+
+    if wind_mph is not None:
+        result['windchill'] = derived_windchill_f(temp_f, wind_mph)
+
+        # Apparent temperature from Steadman
+        vapor_pressure = hum / 100.0 * 6.105 * math.exp(DERIVED_MAGNUS_B * temp_c / (DERIVED_MAGNUS_C + temp_c))
+        app_temp_c = temp_c + 0.33 * vapor_pressure - 0.70 * wind_mph * DERIVED_MPH_TO_MS - 4.00
+        result['appTemp'] = app_temp_c * DERIVED_C_TO_F + 32.0
+
+    return result
+
+
+class WLLDerived():
+
+    def __init__(self, device_registry):
+
+        # Build once the fields read and written for each configured device measuring both temperature and
+        # humidity (iss and extraTempHum<n>)
+
+        self.devices = []
+        self.cache = {}
+
+        for device in device_registry.devices:
+            if device.temp_field is None or device.hum_field is None:
+                continue
+
+            if device.is_iss:
+                target_fields = {'dewpoint': 'dewpoint', 'heatindex': 'heatindex', 'windchill': 'windchill',
+                                 'humidex': 'humidex', 'appTemp': 'appTemp'}
+            else:
+                number = str(device.number)
+                target_fields = dict((name, 'extra' + name[0].upper() + name[1:] + number)
+                                     for name in ('dewpoint', 'heatindex', 'windchill', 'humidex', 'appTemp'))
+
+            self.devices.append((device.temp_field, device.hum_field, target_fields))
+
+        logdbg("Derived quantities computed for : {}".format([d[0] for d in self.devices]))
+
+    def calculate(self, packet):
+
+        # Return derived values missing in packet, values are cached while inputs do not change
+
+        derived = {}
+        wind_mph = packet.get('windSpeed')
+
+        for temp_field, hum_field, target_fields in self.devices:
+            temp_f = packet.get(temp_field)
+            hum = packet.get(hum_field)
+
+            if temp_f is None or hum is None:
+                continue
+
+            key = (temp_f, hum, wind_mph)
+            cached = self.cache.get(temp_field)
+
+            if cached is not None and cached[0] == key:
+                values = cached[1]
+            else:
+                values = derived_values(temp_f, hum, wind_mph)
+                self.cache[temp_field] = (key, values)
+
+            for name, value in values.items():
+                target = target_fields[name]
+                if packet.get(target) is None:
+                    derived[target] = value
+
+        return derived
+
+
+class WLLCoalescer():
+
+    def __init__(self, interval, clock=time.time):
+
+        # Merge UDP and HTTP packets received during interval seconds into one packet :
+        # latest value of each field, maximum of gust (including wind speed) and rain rate, sum of rain
+
+        self.interval = interval
+        self.clock = clock
+        self.packet = None
+        self.window_start = None
+        self.merged = 0
+
+    def add(self, packet):
+
+        if self.packet is None:
+            self.packet = copy.copy(packet)
+            self.window_start = self.clock()
+            self.merged = 1
+            self.merge_gust(packet)
+
+        else:
+            rain = self.packet.get('rain')
+            rainRate = self.packet.get('rainRate')
+            windGust = self.packet.get('windGust')
+            windGustDir = self.packet.get('windGustDir')
+            dateTime = self.packet['dateTime']
+
+            self.packet.update(packet)
+            self.merged += 1
+
+            if packet.get('dateTime') is None or (dateTime is not None and dateTime > packet['dateTime']):
+                self.packet['dateTime'] = dateTime
+
+            if rain is not None:
+                self.packet['rain'] = rain + packet['rain'] if packet.get('rain') is not None else rain
+
+            if rainRate is not None and (packet.get('rainRate') is None or rainRate > packet['rainRate']):
+                self.packet['rainRate'] = rainRate
+
+            if windGust is not None and (packet.get('windGust') is None or windGust >= packet['windGust']):
+                self.packet['windGust'] = windGust
+                self.packet['windGustDir'] = windGustDir
+
+            self.merge_gust(packet)
+
+        return self.pop_ready()
+
+    def merge_gust(self, packet):
+
+        # Wind speed of 2.5s UDP packets can be higher than the gust reported
+
+        windSpeed = packet.get('windSpeed')
+
+        if windSpeed is not None and (self.packet.get('windGust') is None or windSpeed > self.packet['windGust']):
+            self.packet['windGust'] = windSpeed
+            self.packet['windGustDir'] = packet.get('windDir')
+
+    def pop_ready(self, flush=False):
+
+        if self.packet is None or (not flush and self.clock() - self.window_start < self.interval):
+            return
+
+        _packet = self.packet
+        logdbg("Coalesced {} packets : {}".format(self.merged, _packet))
+        self.packet = None
+        self.window_start = None
+        self.merged = 0
+
+        return _packet
+
+
+# Layout of the shared memory ring buffer used to publish loop packets to other local processes :
+#   header : magic, version, number of slots, size of slot, number of packets written
+#   slot   : sequence, length of payload, payload (packet in JSON)
+# Only the driver writes. A slot sequence is odd while written and 2 * (packet number + 1) once done, a reader
+# keeps the payload only if the sequence is the expected one before and after the copy (seqlock, no lock taken).
+
+RING_MAGIC = b'WLLR'
+RING_VERSION = 1
+RING_HEADER = struct.Struct('<4sHxxIIQ')
+RING_SLOT_HEADER = struct.Struct('<QI')
+RING_SEQ = struct.Struct('<Q')
+RING_WRITE_SEQ_OFFSET = RING_HEADER.size - RING_SEQ.size
+
+
+class WLLSharedRingWriter():
+
+    def __init__(self, path, slots, slot_size):
+
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.write_seq = 0
+
+        size = RING_HEADER.size + self.slots * self.slot_size
+
+        with open(self.path, 'w+b') as f:
+            f.truncate(size)
+            self.mm = mmap.mmap(f.fileno(), size)
+
+        self.mm[0:RING_HEADER.size] = RING_HEADER.pack(RING_MAGIC, RING_VERSION, self.slots, self.slot_size, 0)
+        logdbg("Shared ring buffer of {} slots created in {}".format(self.slots, self.path))
+
+    def publish(self, packet):
+
+        payload = json.dumps(packet, separators=(',', ':')).encode('utf-8')
+
+        if len(payload) > self.slot_size - RING_SLOT_HEADER.size:
+            logerr("Packet too large for shared ring buffer slot ({} bytes), increase shm_slot_size".format(
+                len(payload)))
+            return
+
+        offset = RING_HEADER.size + (self.write_seq % self.slots) * self.slot_size
+
+        RING_SEQ.pack_into(self.mm, offset, 2 * self.write_seq + 1)
+        self.mm[offset + RING_SLOT_HEADER.size:offset + RING_SLOT_HEADER.size + len(payload)] = payload
+        RING_SLOT_HEADER.pack_into(self.mm, offset, 2 * self.write_seq + 2, len(payload))
+
+        self.write_seq += 1
+        RING_SEQ.pack_into(self.mm, RING_WRITE_SEQ_OFFSET, self.write_seq)
+
+    def close(self):
+
+        self.mm.close()
+
+
+class WLLSharedRingReader():
+
+    def __init__(self, path):
+
+        # Reader for other processes, start with the next packet published
+
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.slots, self.slot_size, self.next_seq = RING_HEADER.unpack_from(self.mm, 0)
+
+        if magic != RING_MAGIC or version != RING_VERSION:
+            raise ValueError('{} is not a WLLDriver shared ring buffer'.format(path))
+
+        self.lost = 0
+
+    def read_new(self):
+
+        # Return packets published since the last call, skipped packets overwritten by the writer are counted
+
+        packets = []
+        write_seq = RING_SEQ.unpack_from(self.mm, RING_WRITE_SEQ_OFFSET)[0]
+
+        if write_seq < self.next_seq:
+            # Writer restarted
+            self.next_seq = 0
+
+        if write_seq - self.next_seq > self.slots:
+            self.lost += write_seq - self.next_seq - self.slots
+            self.next_seq = write_seq - self.slots
+
+        while self.next_seq < write_seq:
+            offset = RING_HEADER.size + (self.next_seq % self.slots) * self.slot_size
+            expected_seq = 2 * self.next_seq + 2
+
+            seq, length = RING_SLOT_HEADER.unpack_from(self.mm, offset)
+            payload = self.mm[offset + RING_SLOT_HEADER.size:offset + RING_SLOT_HEADER.size + length]
+
+            if seq == expected_seq and RING_SEQ.unpack_from(self.mm, offset)[0] == expected_seq:
+                packets.append(json.loads(payload.decode('utf-8')))
+            else:
+                self.lost += 1
+
+            self.next_seq += 1
+
+        return packets
+
+    def follow(self, poll=0.5):
+
+        # Generator of packets for consumers
+
+        while True:
+            for _packet in self.read_new():
+                yield _packet
+
+            time.sleep(poll)
+
+    def close(self):
+
+        self.mm.close()
+
+
+class WLLCacheProxyHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        proxy = self.server.proxy
+        path, _, query = self.path.partition('?')
+
+        try:
+            if path == '/v1/current_conditions':
+                body = proxy.get_current_conditions()
+
+            elif path == '/v1/real_time':
+                duration = 1200
+                for parameter in query.split('&'):
+                    key, _, value = parameter.partition('=')
+                    if key == 'duration' and value.isdigit():
+                        duration = int(value)
+                body = proxy.get_realtime_broadcast(duration)
+
+            else:
+                self.send_error(404)
+                return
+
+        except weewx.WeeWxIOError as error:
+            logdbg("Cache proxy failed to request WLL : {}".format(error))
+            self.send_error(502)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        logdbg("Cache proxy : {}".format(format % args))
+
+
+class WLLCacheProxy():
+
+    def __init__(self, api, host, port, max_age):
+
+        # Serve the last current_conditions of the driver poll to other clients, the WLL is requested only
+        # if the cache is older than max_age and concurrent requests wait for the same answer
+
+        self.api = api
+        self.max_age = max_age
+        self.current_conditions = None
+        self.current_conditions_time = 0
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+
+        self.server = http.server.ThreadingHTTPServer((host, port), WLLCacheProxyHandler)
+        self.server.daemon_threads = True
+        self.server.proxy = self
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name='WLLCacheProxy')
+        self.thread.daemon = True
+        self.thread.start()
+
+        loginf("Cache proxy of WLL listen on {}:{}".format(host, port))
+
+    def store(self, json_data):
+
+        # Called by the driver after each poll
+
+        body = json.dumps(json_data).encode('utf-8')
+
+        with self.lock:
+            self.current_conditions = body
+            self.current_conditions_time = time.time()
+
+    def get_cached(self):
+
+        with self.lock:
+            if self.current_conditions is not None and time.time() - self.current_conditions_time <= self.max_age:
+                return self.current_conditions
+
+    def get_current_conditions(self):
+
+        body = self.get_cached()
+
+        if body is None:
+            with self.fetch_lock:
+                # Another client may have refreshed the cache while waiting
+                body = self.get_cached()
+
+                if body is None:
+                    json_data = self.api.request_json_data(self.api.url_current_conditions,
+                                                           self.api.api_parameters['time_out'], 'current_conditions')
+                    self.store(json_data)
+                    body = self.get_cached()
+
+        return body
+
+    def get_realtime_broadcast(self, duration):
+
+        # The driver keep the broadcast alive, the WLL is requested only if it stops before duration
+
+        remaining = self.api.renew_realtime_broadcast(duration)
+
+        return json.dumps({'data': {'broadcast_port': 22222, 'duration': int(remaining)},
+                           'error': None}).encode('utf-8')
+
+    def close(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class WLLCircuitBreaker():
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+
+        # Open the circuit after failure_threshold failures in a row, then let one probe go through each
+        # reset_timeout seconds (half open) until the source answers again
+
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.last_success = time.time()
+        self.opened_at = None
+        self.probe_at = None
+        self.opens = 0
+        self.total_detect = 0
+        self.total_recover = 0
+        self.recovers = 0
+
+    def allow_request(self):
+
+        if self.state == 'open' and time.time() >= self.probe_at:
+            self.state = 'half_open'
+            logdbg("Circuit {} half open, probe source".format(self.name))
+
+        return self.state != 'open'
+
+    def is_open(self):
+
+        return self.state != 'closed'
+
+    def record_success(self):
+
+        if self.state != 'closed':
+            recover = time.time() - self.opened_at
+            self.total_recover += recover
+            self.recovers += 1
+            loginf("Circuit {} closed, source recovered in {:.1f}s".format(self.name, recover))
+
+        self.state = 'closed'
+        self.failures = 0
+        self.last_success = time.time()
+
+    def record_failure(self):
 
-comsocket = socket(AF_INET, SOCK_DGRAM)
-comsocket.bind(('0.0.0.0', 22222))
-comsocket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+        self.failures += 1
 
-try:
-    import weeutil.logger
-    import logging
+        if self.state == 'half_open':
+            self.state = 'open'
+            self.probe_at = time.time() + self.reset_timeout
+            logdbg("Circuit {} probe failed, stay open".format(self.name))
 
-    log = logging.getLogger(__name__)
-    def logdbg(msg):
-        log.debug(msg)
-    def loginf(msg):
-        log.info(msg)
-    def logerr(msg):
-        log.error(msg)
+        elif self.state == 'closed' and self.failures >= self.failure_threshold:
+            self.state = 'open'
+            self.opened_at = time.time()
+            self.probe_at = self.opened_at + self.reset_timeout
+            detect = self.opened_at - self.last_success
+            self.total_detect += detect
+            self.opens += 1
+            logerr("Circuit {} open after {} failures, failure detected in {:.1f}s".format(self.name, self.failures,
+                                                                                          detect))
 
-except ImportError:
-    import syslog
+    def stats(self):
 
+        return {'state': self.state,
+                'opens': self.opens,
+                'mean_time_to_detect': self.total_detect / self.opens if self.opens else None,
+                'mean_time_to_recover': self.total_recover / self.recovers if self.recovers else None,
+                }
 
-    def logmsg(level, msg):
-        syslog.syslog(level, 'WLLDriver: %s:' % msg)
-    def logdbg(msg):
-        logmsg(syslog.LOG_DEBUG, msg)
-    def loginf(msg):
-        logmsg(syslog.LOG_INFO, msg)
-    def logerr(msg):
-        logmsg(syslog.LOG_ERR, msg)
+
+# Layout of record files : each input is a header (arrival time, type of packet, length) then the
+# payload compressed with zlib
+
+RECORD_HEADER = struct.Struct('<dBI')
+RECORD_TYPES = ('current_conditions', 'realtime_broadcast')
+
+
+class WLLRecorder():
+
+    def __init__(self, record_file):
+
+        self.record_file = record_file
+        self.file = open(self.record_file, 'ab')
+        logdbg("Record raw inputs of WLL in {}".format(self.record_file))
+
+    def record(self, type_of_packet, payload, arrival=None):
+
+        if arrival is None:
+            arrival = time.time()
+
+        compressed = zlib.compress(payload)
+
+        try:
+            self.file.write(RECORD_HEADER.pack(arrival, RECORD_TYPES.index(type_of_packet), len(compressed)))
+            self.file.write(compressed)
+            self.file.flush()
+
+        except OSError as error:
+            logerr("Unable to record input to {} : {}".format(self.record_file, error))
+
+    def close(self):
+
+        self.file.close()
+
+
+def read_record_file(record_file):
+
+    # Iterate (arrival, type of packet, raw payload) of a record file, stop on a truncated input
+
+    with open(record_file, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+
+            arrival, type_index, length = RECORD_HEADER.unpack(header)
+            compressed = f.read(length)
+            if len(compressed) < length:
+                logdbg("Record file {} has a truncated input, stop reading".format(record_file))
+                return
+
+            yield arrival, RECORD_TYPES[type_index], zlib.decompress(compressed)
+
+
+class WLLReplay():
+
+    def __init__(self, stn_dict, record_file, speed):
+
+        # Feed a record file through the decoder, the rain ledger, the filter and the coalescer as the driver
+        # does, at speed times the real time (0 for as fast as possible). stn_dict is the [WLLDriver] section of
+        # weewx.conf. Rain ledger is kept in memory, Health API and outputs are disabled.
+
+        replay_dict = dict(stn_dict)
+        replay_dict.update({'udp_enable': 1,
+                            'rain_state_file': '',
+                            'record_file': '',
+                            'columnar_enable': 0,
+                            'shm_path': '',
+                            'proxy_port': 0,
+                            'failover_enable': 0,
+                            })
+
+        self.driver = WLLDriver(**replay_dict)
+        self.api = self.driver.WLLDriverAPI
+
+        # Windows of the filter and the coalescer follow the arrival time of inputs
+        self.driver.packet_filter.clock = self.api.now
+        if self.driver.coalescer is not None:
+            self.driver.coalescer.clock = self.api.now
+
+        self.record_file = record_file
+        self.speed = speed
+        self.errors = 0
+
+    def genPackets(self):
+
+        first_arrival = None
+        start_time = time.time()
+
+        for arrival, type_of_packet, payload in read_record_file(self.record_file):
+            if first_arrival is None:
+                first_arrival = arrival
+
+            if self.speed > 0:
+                wait = start_time + (arrival - first_arrival) / self.speed - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+
+            self.api.replay_time = arrival
+
+            try:
+                data = json.loads(payload.decode('utf-8'))
+
+            except ValueError as e:
+                # Datagrams are recorded before being parsed, a malformed one only skips this input
+                self.errors += 1
+                logdbg("Replay input at {} is not valid JSON : {}".format(arrival, e))
+                continue
+
+            try:
+                for _packet_wll in self.api.decode_wll(data, type_of_packet):
+                    if _packet_wll is not None:
+                        for _packet in self.driver.send_packets(self.driver.packet_filter.push(type_of_packet,
+                                                                                               _packet_wll)):
+                            yield _packet
+
+            except weewx.WeeWxIOError as e:
+                self.errors += 1
+                logdbg("Replay input at {} failed : {}".format(arrival, e))
+
+        # End of the record, send packets still held
+        for _packet in self.driver.send_packets(self.driver.packet_filter.pop_ready(flush=True)):
+            yield _packet
+
+        if self.driver.coalescer is not None:
+            _coalesced_packet = self.driver.coalescer.pop_ready(flush=True)
+            if _coalesced_packet is not None:
+                yield _coalesced_packet
+
+    def close(self):
+
+        self.driver.closePort()
 
 
 class WLLDriverAPI():
 
     def __init__(self, api_parameters):
 
-        # Define sensor ID for Weatherlink.com
-        self.dict_sensor_type = {'iss': {23, 24, 27, 28, 43, 44, 45, 46, 48, 49, 50,
-                                         51, 76, 77, 78, 79, 80, 81, 82, 83},
-                                 'extraTemp': {55},
-                                 'extraHumid': {55},
-                                 }
-
         # Define values for driver work
         self.api_parameters = api_parameters
-        device_id = self.api_parameters['device_id']
-        self.rain_previous_period = None
+        self.device_registry = WLLDeviceRegistry(self.api_parameters['device_id'])
+        self.sensor_registry = WLLSensorRegistry(self.device_registry, self.api_parameters['wind_gust_2m_enable'])
+        self.rain_ledger = WLLRainLedger(self.api_parameters['rain_state_file'])
         self.udp_countdown = 0
-        self.length_dict_device_id = None
-        self.dict_device_id = dict((int(k), v) for k, v in (e.split(':') for e in device_id.split('-')))
-        self.length_dict_device_id = len(self.dict_device_id)
+        self.wl_archive_seconds = self.api_parameters['wl_archive_interval'] * 60
         self.check_health_time = False
         self.health_timestamp_archive = None
 
+        # Define columnar store to keep raw loop stream
+        self.columnar_store = None
+        if self.api_parameters['columnar_enable'] == 1:
+            self.columnar_store = WLLColumnarWriter(self.api_parameters['columnar_path'],
+                                                    self.api_parameters['columnar_chunk_size'],
+                                                    self.api_parameters['columnar_flush_interval'])
+
+        # Define shared ring buffer to publish packets to other local processes
+        self.shared_ring = None
+        if self.api_parameters['shm_path']:
+            self.shared_ring = WLLSharedRingWriter(self.api_parameters['shm_path'], self.api_parameters['shm_slots'],
+                                                   self.api_parameters['shm_slot_size'])
+
+        # Define derived quantities computed by the driver
+        self.derived = None
+        if self.api_parameters['derived_enable'] == 1:
+            self.derived = WLLDerived(self.device_registry)
+
+        # Define recorder of raw inputs, and time of the input replayed
+        self.recorder = None
+        if self.api_parameters['record_file']:
+            self.recorder = WLLRecorder(self.api_parameters['record_file'])
+        self.replay_time = None
+
+        # Define tracer of packets and decoder profiler
+        self.tracer = WLLTracer(self.api_parameters['trace_file'], self.api_parameters['trace_sample'],
+                                self.api_parameters['profile_file'], self.api_parameters['profile_every'])
+
+        # Socket for udp broadcast, bound on first use so importing this module doesn't take the port
+        self.comsocket = None
+
         # Define URL for current conditions and udp broadcast
         self.url_current_conditions = "http://{}:{}/v1/current_conditions".format(self.api_parameters['hostname'],
                                                                                   self.api_parameters['port'])
         logdbg("URL of current_conditions : {}".format(self.url_current_conditions))
-        self.url_realtime_broadcast = "http://{}:{}/v1/real_time?duration=3600".format(self.api_parameters['hostname'],
-                                                                                       self.api_parameters['port'])
+        self.realtime_duration = 3600
+        self.url_realtime_broadcast = "http://{}:{}/v1/real_time?duration={}".format(self.api_parameters['hostname'],
+                                                                                     self.api_parameters['port'],
+                                                                                     self.realtime_duration)
         logdbg("URL of realtime_broadcast : {}".format(self.url_realtime_broadcast))
 
+        # Define local cache proxy of the WLL HTTP API, it serves requests as soon as it starts
+        self.realtime_lock = threading.Lock()
+        self.cache_proxy = None
+        if self.api_parameters['proxy_port'] > 0:
+            self.cache_proxy = WLLCacheProxy(self, self.api_parameters['proxy_host'], self.api_parameters['proxy_port'],
+                                             self.api_parameters['proxy_max_age'])
+
         # Init time to request Health API
         self.set_time_health_api()
 
@@ -92,43 +1699,21 @@ class WLLDriverAPI():
 
         # Get the last timestamp of Weatherlink archive interval set in conf driver
 
-        timestamp_wl_archive = int(
-            math.floor((time.time() - 60) / (self.api_parameters['wl_archive_interval'] * 60)) *
-            (self.api_parameters['wl_archive_interval'] * 60))
-
-        return timestamp_wl_archive
+        return self.get_timestamp_by_time(time.time())
 
     def get_timestamp_by_time(self, timestamp):
 
-        # Get timestamp from specific time of Weatherlink archive interval set in conf driver
-
-        timestamp_wl_archive = int(
-            math.floor((timestamp - 60) / (self.api_parameters['wl_archive_interval'] * 60)) *
-            (self.api_parameters['wl_archive_interval'] * 60))
-
-        return timestamp_wl_archive
+        # Get timestamp from specific time of Weatherlink archive interval set in conf driver, with 60 secondes
+        # to let Weatherlink.com archive new data
 
-    def round_minutes(self,timestamp, direction, resolution):
+        return align_down(timestamp - 60, self.wl_archive_seconds)
 
-        now = datetime.fromtimestamp(timestamp)
-        dt = now.replace(second=0, microsecond=0)
-        print(dt)
-        new_minute = (dt.minute // resolution + (1 if direction == 'up' else 0)) * resolution
-        result = dt + timedelta(minutes=new_minute - dt.minute)
-        print(result)
-
-        return int(datetime.timestamp(result))
-
-    def request_json_data(self, url, request_timeout, type_of_request):
-
-        json_data = None
+    def request_http(self, url, request_timeout, type_of_request):
 
         try:
             http_session = requests.session()
-            json_data = http_session.get(url, timeout=request_timeout)
-
-            if json_data is not None:
-                return json_data.json()
+            with self.tracer.span('http_wait'):
+                return http_session.get(url, timeout=request_timeout)
 
         except requests.Timeout as error:
             if type_of_request == 'HealthAPI':
@@ -144,7 +1729,39 @@ class WLLDriverAPI():
             else:
                 raise weewx.WeeWxIOError('Request exception from {} : {}'.format(type_of_request, error))
 
-    def calculate_rain(self, rainFall_Daily, rainRate, rainSize):
+    def decode_json(self, response, type_of_request):
+
+        if response is None:
+            return
+
+        try:
+            with self.tracer.span('json_parse'):
+                return response.json()
+
+        except ValueError as error:
+            if type_of_request == 'HealthAPI':
+                logdbg('Invalid JSON for HealthAPI, pass.')
+                return
+            else:
+                raise weewx.WeeWxIOError('Invalid JSON from {} : {}'.format(type_of_request, error))
+
+    def request_json_data(self, url, request_timeout, type_of_request):
+
+        return self.decode_json(self.request_http(url, request_timeout, type_of_request), type_of_request)
+
+    def request_current_conditions(self):
+
+        # Request current_conditions of the WLL, the raw answer is recorded before being parsed
+
+        response = self.request_http(self.url_current_conditions, self.api_parameters['time_out'],
+                                     'current_conditions')
+
+        if self.recorder is not None and response is not None:
+            self.recorder.record('current_conditions', response.content)
+
+        return self.decode_json(response, 'current_conditions')
+
+    def calculate_rain(self, rainFall_Daily, rainRate, rainSize, timestamp, source):
 
         # Set values to None to prevent no declaration
         rain = None
@@ -161,24 +1778,18 @@ class WLLDriverAPI():
             if rainSize == 3:
                 rain_multiplier = 0.1
 
-        # Calculate rain
-        if rainFall_Daily is not None and rain_multiplier is not None:
-            if self.rain_previous_period is not None:
-                if (rainFall_Daily - self.rain_previous_period) < 0:
-                    logdbg('Not negative number. Set rain to 0. Essentially caused by reset midnight')
-                    self.rain_previous_period = 0
-                    rain = 0
-                else:
-                    rain = (rainFall_Daily - self.rain_previous_period) * rain_multiplier
+        # Calculate rain from the tips counted by the ledger
+        if rainFall_Daily is not None and rainFall_Daily >= 0 and rain_multiplier is not None:
+            rain = self.rain_ledger.update(timestamp, rainFall_Daily, source) * rain_multiplier
 
-                if rain is not None and rainSize is not None and rain > 0:
-                    logdbg("Rain now : {}".format(rain))
+            if rain > 0:
+                logdbg("Rain now : {}".format(rain))
 
-                    if rainSize == 2:
-                        rain = rain / 25.4
+                if rainSize == 2:
+                    rain = rain / 25.4
 
-                    if rainSize == 3:
-                        rain = rain / 2.54
+                if rainSize == 3:
+                    rain = rain / 2.54
         else:
             rain = None
 
@@ -196,52 +1807,37 @@ class WLLDriverAPI():
         else:
             rainRate = None
 
-        # Set rainFall_Daily to previous rain
-        if rainFall_Daily is not None and rainFall_Daily >= 0:
-            self.rain_previous_period = rainFall_Daily
-            logdbg("Rainfall_Daily set after calculated : {}".format(self.rain_previous_period))
-
         return rain, rainRate
 
     def data_decode_health_wl(self, data, timestamp):
 
         # Function to decode health data from Weatherlink.com
 
-        # Copie json data to new value
-        data_wl = data
+        # Health API request failed, pass
+        if data is None:
+            return
+
         # Set new dict
         dict_health = {}
 
-        for nmb_device_id in range(1, len(self.dict_device_id) + 1, 1):
-            for index_json in range(0, len(data_wl['sensors']), 1):
-                for device_id, device in self.dict_device_id.items():
-                    temp_dict_device_id = self.dict_device_id[device_id]
-                    temp_dict_device_id = ''.join([i for i in temp_dict_device_id if not i.isdigit()])
-
-                    for sensor_type_id in self.dict_sensor_type[temp_dict_device_id]:
-                        for s in data_wl['sensors']:
-                            if s['sensor_type'] == sensor_type_id:
-                                for s in data_wl['sensors'][index_json]['data']:
-                                    if 'tx_id' in s and s['tx_id'] == device_id and s['ts'] == timestamp:
-                                        if 'reception' in s:
-                                            if self.dict_device_id[device_id] == 'iss' or \
-                                                    self.dict_device_id[device_id] == 'iss+':
-                                                dict_health['rxCheckPercent'] = s['reception']
-
-                        for s in data_wl['sensors']:
-                            if s['sensor_type'] == 504:
-                                for s in data_wl['sensors'][index_json]['data']:
-                                    if s['ts'] == timestamp:
-                                        if 'battery_voltage' in s:
-                                            tmp_battery_voltage = s['battery_voltage']
-                                            if tmp_battery_voltage is not None:
-                                                tmp_battery_voltage = tmp_battery_voltage / 1000
-                                                dict_health['consBatteryVoltage'] = tmp_battery_voltage
-                                        if 'input_voltage' in s:
-                                            tmp_input_voltage = s['input_voltage']
-                                            if tmp_input_voltage is not None:
-                                                tmp_input_voltage = tmp_input_voltage / 1000
-                                                dict_health['supplyVoltage'] = tmp_input_voltage
+        for s in data['sensors']:
+            sensor_type = s['sensor_type']
+
+            if sensor_type == 504:
+                for row in s['data']:
+                    if row['ts'] == timestamp:
+                        if row.get('battery_voltage') is not None:
+                            dict_health['consBatteryVoltage'] = row['battery_voltage'] / 1000
+                        if row.get('input_voltage') is not None:
+                            dict_health['supplyVoltage'] = row['input_voltage'] / 1000
+
+            elif sensor_type in self.device_registry.sensor_types:
+                for row in s['data']:
+                    device = self.device_registry.by_txid.get(row.get('tx_id'))
+
+                    if device is not None and device.is_iss and sensor_type in device.sensor_types and \
+                            row['ts'] == timestamp and 'reception' in row:
+                        dict_health['rxCheckPercent'] = row['reception']
 
         if dict_health is not None and dict_health != {}:
             logdbg("Health Packet received from Weatherlink.com : {}".format(dict_health))
@@ -252,19 +1848,13 @@ class WLLDriverAPI():
         # Function to decode data from Weatherlink.com
 
         try:
-            # Copie json data to new value
-            data_wl = data
-
-            # Set dict
-            extraTemp = {}
-            extraHumid = {}
-            wl_packet = {'dateTime': None,
-                         'usUnits': weewx.US,
-                         'interval': self.api_parameters['wl_archive_interval'],
-                         }
+            # Index rows of each sensor by timestamp once, instead of scanning them for each archive interval
+            rows_by_ts = {}
+            for s in data['sensors']:
+                sensor_type = s['sensor_type']
 
-            # Set values to None
-            rainSize = None
+                for row in s['data']:
+                    rows_by_ts.setdefault(row['ts'], []).append((sensor_type, row))
 
             # Calculate timestamp from start
             start_timestamp = int(start_timestamp + (60 * int(self.api_parameters['wl_archive_interval'])))
@@ -272,138 +1862,20 @@ class WLLDriverAPI():
             while start_timestamp <= end_timestamp:
                 logdbg("Request archive for timestamp : {}".format(start_timestamp))
 
-                for nmb_device_id in range(1, len(self.dict_device_id) + 1, 1):
-                    for index_json in range(0, len(data_wl['sensors']), 1):
-                        for device_id, device in self.dict_device_id.items():
-                            temp_dict_device_id = self.dict_device_id[device_id]
-                            temp_dict_device_id = ''.join([i for i in temp_dict_device_id if not i.isdigit()])
-
-                            for sensor_type_id in self.dict_sensor_type[temp_dict_device_id]:
-                                for s in data_wl['sensors']:
-                                    if s['sensor_type'] == sensor_type_id:
-                                        for s in data_wl['sensors'][index_json]['data']:
-                                            if 'tx_id' in s and s['tx_id'] == device_id and s['ts'] == start_timestamp:
-                                                if 'temp_last' in s:
-                                                    if self.dict_device_id[device_id] == 'iss' or \
-                                                            self.dict_device_id[device_id] == 'iss+':
-                                                        wl_packet['outTemp'] = s['temp_last']
-
-                                                    if self.dict_device_id[device_id] in 'extraTemp{}'.format(
-                                                            nmb_device_id):
-                                                        extraTemp[
-                                                            'extraTemp{}'.format(nmb_device_id)] = \
-                                                            s['temp_last']
-
-                                                if 'hum_last' in s:
-                                                    if self.dict_device_id[device_id] == 'iss' or \
-                                                            self.dict_device_id[device_id] == 'iss+':
-                                                        wl_packet['outHumidity'] = s['hum_last']
-
-                                                    if self.dict_device_id[device_id] == 'extraHumid{}'.format(
-                                                            nmb_device_id):
-                                                        extraHumid[
-                                                            'extraHumid{}'.format(
-                                                                nmb_device_id)] = s['hum_last']
-                                                if 'reception' in s:
-                                                    if self.dict_device_id[device_id] == 'iss' or \
-                                                            self.dict_device_id[device_id] == 'iss+':
-                                                        wl_packet['rxCheckPercent'] = s['reception']
-                                                if 'dew_point_last' in s:
-                                                    wl_packet['dewpoint'] = s['dew_point_last']
-                                                if 'rain_size' in s:
-                                                    rainSize = s['rain_size']
-                                                if 'heat_index_last' in s:
-                                                    wl_packet['heatindex'] = s['heat_index_last']
-                                                if 'wind_chill_last' in s:
-                                                    wl_packet['windchill'] = s['wind_chill_last']
-                                                if 'wind_speed_avg' in s:
-                                                    wl_packet['windSpeed'] = s['wind_speed_avg']
-                                                if 'wind_dir_of_prevail' in s:
-                                                    wl_packet['windDir'] = s['wind_dir_of_prevail']
-                                                if 'wind_speed_hi' in s:
-                                                    wl_packet['windGust'] = s['wind_speed_hi']
-                                                if 'wind_speed_hi_dir' in s:
-                                                    wl_packet['windGustDir'] = s['wind_speed_hi_dir']
-                                                if 'uv_index_avg' in s:
-                                                    wl_packet['UV'] = s['uv_index_avg']
-                                                if 'solar_rad_avg' in s:
-                                                    wl_packet['radiation'] = s['solar_rad_avg']
-
-                                                if rainSize == 1:
-                                                    if 'rain_rate_hi_in' in s:
-                                                        wl_packet['rainRate'] = s['rain_rate_hi_in']
-
-                                                    if 'rainfall_in' in s:
-                                                        wl_packet['rain'] = s['rainfall_in']
-
-                                                if rainSize == 2:
-                                                    if 'rain_rate_hi_mm' in s:
-                                                        rainRate = s['rain_rate_hi_mm']
-
-                                                        if rainRate is not None:
-                                                            wl_packet['rainRate'] = rainRate / 25.4
-
-                                                    if 'rainfall_mm' in s:
-                                                        rain = s['rainfall_mm']
-
-                                                        if rain is not None:
-                                                            wl_packet['rain'] = rain / 25.4
-
-                                                # if rainSize == 3:
-
-                                                # What about this value ? It is not implement on weatherlink.com ?
-
-                                for s in data_wl['sensors']:
-                                    if s['sensor_type'] == 242:
-                                        for s in data_wl['sensors'][index_json]['data']:
-                                            if s['ts'] == start_timestamp:
-                                                if 'bar_sea_level' in s:
-                                                    wl_packet['barometer'] = s['bar_sea_level']
-                                                if 'bar_absolute' in s:
-                                                    wl_packet['pressure'] = s['bar_absolute']
-
-                                for s in data_wl['sensors']:
-                                    if s['sensor_type'] == 243:
-                                        for s in data_wl['sensors'][index_json]['data']:
-                                            if s['ts'] == start_timestamp:
-                                                if 'temp_in_last' in s:
-                                                    wl_packet['inTemp'] = s['temp_in_last']
-                                                if 'hum_in_last' in s:
-                                                    wl_packet['inHumidity'] = s['hum_in_last']
-                                                if 'dew_point_in' in s:
-                                                    wl_packet['inDewpoint'] = s['dew_point_in']
-
-                                for s in data_wl['sensors']:
-                                    if s['sensor_type'] == 504:
-                                        for s in data_wl['sensors'][index_json]['data']:
-                                            if s['ts'] == start_timestamp:
-                                                if 'battery_voltage' in s:
-                                                    tmp_battery_voltage = s['battery_voltage']
-                                                    if tmp_battery_voltage is not None:
-                                                        tmp_battery_voltage = tmp_battery_voltage / 1000
-                                                        wl_packet['consBatteryVoltage'] = tmp_battery_voltage
-                                                if 'input_voltage' in s:
-                                                    tmp_input_voltage = s['input_voltage']
-                                                    if tmp_input_voltage is not None:
-                                                        tmp_input_voltage = tmp_input_voltage / 1000
-                                                        wl_packet['supplyVoltage'] = tmp_input_voltage
-
-                wl_packet['dateTime'] = start_timestamp
-
-                if len(self.dict_device_id) > 1:
-                    if extraTemp is not None and extraTemp != {}:
-                        wl_packet.update(extraTemp)
+                # Set dict
+                wl_packet = {'dateTime': None,
+                             'usUnits': weewx.US,
+                             'interval': self.api_parameters['wl_archive_interval'],
+                             }
 
-                    if extraHumid is not None and extraHumid != {}:
-                        wl_packet.update(extraHumid)
+                for sensor_type, s in rows_by_ts.get(start_timestamp, ()):
+                    WLLSensorRegistry.decode(self.sensor_registry.historic, sensor_type, s, 'tx_id', wl_packet, None)
 
-                if wl_packet is not None and wl_packet['dateTime'] is not None:
-                    logdbg("Packet received from Weatherlink.com : {}".format(wl_packet))
-                    start_timestamp = int(start_timestamp + (60 * int(self.api_parameters['wl_archive_interval'])))
-                    yield wl_packet
+                wl_packet['dateTime'] = start_timestamp
 
-                else:
-                    raise weewx.WeeWxIOError('No data present in Weatherlink.com packet but request is OK')
+                logdbg("Packet received from Weatherlink.com : {}".format(wl_packet))
+                start_timestamp = int(start_timestamp + (60 * int(self.api_parameters['wl_archive_interval'])))
+                yield wl_packet
 
         except KeyError as error:
             raise weewx.WeeWxIOError('API Data from Weatherlink is invalid. Error is : {}'.format(error))
@@ -416,191 +1888,69 @@ class WLLDriverAPI():
 
         try:
             # Set dict
-            extraTemp = {}
-            extraHumid = {}
             wll_packet = {'dateTime': None,
                           'usUnits': weewx.US,
                           }
-            udp_wll_packet = {'dateTime': None,
-                              'usUnits': weewx.US,
-                              }
 
             # Set values to None
-            add_current_rain = None
             _packet = None
-            rainFall_Daily = None
-            rainRate = None
-            rainSize = None
-
-            for device_id, device in self.dict_device_id.items():
-                for nmb_device_id in range(1, len(self.dict_device_id) + 1, 1):
-                    if type_of_packet == 'current_conditions':
-                        logdbg('Current conditions received : {}'.format(data))
-                        if 'ts' in data['data']:
-                            wll_packet['dateTime'] = data['data']['ts']
-
-                        for s in data['data']['conditions']:
-                            if s['data_structure_type'] == 1:
-                                if s['txid'] == device_id:
-                                    if 'temp' in s:
-                                        if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                            device_id] == 'iss+':
-                                            wll_packet['outTemp'] = s['temp']
-
-                                        if self.dict_device_id[device_id] in 'extraTemp{}'.format(
-                                                nmb_device_id):
-                                            extraTemp['extraTemp{}'.format(nmb_device_id)] = s['temp']
-
-                                    if 'hum' in s:
-                                        if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                            device_id] == 'iss+':
-                                            wll_packet['outHumidity'] = s['hum']
-
-                                        if self.dict_device_id[device_id] == 'extraHumid{}'.format(
-                                                nmb_device_id):
-                                            extraHumid['extraHumid{}'.format(nmb_device_id)] = s[
-                                                'hum']
-
-                                    if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                        device_id] == 'iss+':
-                                        if 'dew_point' in s:
-                                            wll_packet['dewpoint'] = s['dew_point']
-                                        if 'heat_index' in s:
-                                            wll_packet['heatindex'] = s['heat_index']
-                                        if 'wind_chill' in s:
-                                            wll_packet['windchill'] = s['wind_chill']
-                                        if 'trans_battery_flag' in s:
-                                            wll_packet['txBatteryStatus'] = s['trans_battery_flag']
-
-                                    if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                        device_id] == 'iss+' or self.dict_device_id[device_id] == 'extra_Anenometer':
-                                        if 'wind_speed_last' in s:
-                                            wll_packet['windSpeed'] = s['wind_speed_last']
-                                        if 'wind_dir_last' in s:
-                                            wll_packet['windDir'] = s['wind_dir_last']
-
-                                        if self.api_parameters['wind_gust_2m_enable'] == 0:
-                                            if 'wind_speed_hi_last_10_min' in s:
-                                                wll_packet['windGust'] = s['wind_speed_hi_last_10_min']
-                                            if 'wind_dir_at_hi_speed_last_10_min' in s:
-                                                wll_packet['windGustDir'] = s['wind_dir_at_hi_speed_last_10_min']
-
-                                        if self.api_parameters['wind_gust_2m_enable'] == 1:
-                                            if 'wind_speed_hi_last_2_min' in s:
-                                                wll_packet['windGust'] = s['wind_speed_hi_last_2_min']
-                                            if 'wind_dir_at_hi_speed_last_2_min' in s:
-                                                wll_packet['windGustDir'] = s['wind_dir_at_hi_speed_last_2_min']
-
-                                    if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                        device_id] == 'iss+':
-                                        if 'rain_rate_last' in s:
-                                            rainRate = s['rain_rate_last']
-                                        if 'rainfall_daily' in s:
-                                            rainFall_Daily = s['rainfall_daily']
-                                        if 'rain_size' in s:
-                                            rainSize = s['rain_size']
-
-                                    if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                        device_id] == 'iss+':
-                                        if 'uv_index' in s:
-                                            wll_packet['UV'] = s['uv_index']
-                                        if 'solar_rad' in s:
-                                            wll_packet['radiation'] = s['solar_rad']
-
-                            # Next lines are not extra, so no need ID
-
-                            if s['data_structure_type'] == 2:
-                                pass
-
-                            if s['data_structure_type'] == 3:
-                                if 'bar_sea_level' in s:
-                                    wll_packet['barometer'] = s['bar_sea_level']
-                                if 'bar_absolute' in s:
-                                    wll_packet['pressure'] = s['bar_absolute']
-
-                            if s['data_structure_type'] == 4:
-                                if 'temp_in' in s:
-                                    wll_packet['inTemp'] = s['temp_in']
-                                if 'hum_in' in s:
-                                    wll_packet['inHumidity'] = s['hum_in']
-                                if 'dew_point_in' in s:
-                                    wll_packet['inDewpoint'] = s['dew_point_in']
-
-                    if type_of_packet == 'realtime_broadcast':
-                        logdbg('Realtime broadcast received : {}'.format(data))
-                        if 'ts' in data:
-                            udp_wll_packet['dateTime'] = data['ts']
-
-                        for s in data['conditions']:
-                            if s['data_structure_type'] == 1:
-                                if s['txid'] == device_id:
-                                    if self.api_parameters['udp_enable'] == 1:
-                                        if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                            device_id] == 'iss+' or self.dict_device_id[
-                                            device_id] == 'extra_Anenometer':
-                                            if 'wind_speed_last' in s:
-                                                udp_wll_packet['windSpeed'] = s['wind_speed_last']
-                                            if 'wind_dir_last' in s:
-                                                udp_wll_packet['windDir'] = s['wind_dir_last']
-                                            if 'wind_speed_hi_last_10_min' in s:
-                                                udp_wll_packet['windGust'] = s['wind_speed_hi_last_10_min']
-                                            if 'wind_dir_at_hi_speed_last_10_min' in s:
-                                                udp_wll_packet['windGustDir'] = s['wind_dir_at_hi_speed_last_10_min']
-
-                                        if self.dict_device_id[device_id] == 'iss' or self.dict_device_id[
-                                            device_id] == 'iss+' or self.dict_device_id[device_id] == 'extra_RainGauge':
-                                            if 'rain_rate_last' in s:
-                                                rainRate = s['rain_rate_last']
-                                            if 'rainfall_daily' in s:
-                                                rainFall_Daily = s['rainfall_daily']
-                                            if 'rain_size' in s:
-                                                rainSize = s['rain_size']
+            rain_data = {}
 
-            logdbg("rainFall_Daily set : {}".format(rainFall_Daily))
+            if type_of_packet == 'current_conditions':
+                logdbg('Current conditions received : {}'.format(data))
+                if 'ts' in data['data']:
+                    wll_packet['dateTime'] = data['data']['ts']
 
-            if self.rain_previous_period is not None:
-                rain, rainRate = self.calculate_rain(rainFall_Daily, rainRate, rainSize)
+                for s in data['data']['conditions']:
+                    WLLSensorRegistry.decode(self.sensor_registry.live, s['data_structure_type'], s, 'txid',
+                                             wll_packet, rain_data)
 
-                if rain is not None and rainRate is not None:
-                    add_current_rain = {'rain': rain,
-                                        'rainRate': rainRate,
-                                        }
-            else:
-                if rainFall_Daily is not None:
-                    if rainFall_Daily >= 0:
-                        self.rain_previous_period = rainFall_Daily
-                        logdbg("rainFall_Daily set by WLLDriver : {}".format(self.rain_previous_period))
+            if type_of_packet == 'realtime_broadcast':
+                logdbg('Realtime broadcast received : {}'.format(data))
+                if 'ts' in data:
+                    wll_packet['dateTime'] = data['ts']
 
-            if type_of_packet == 'current_conditions':
-                if add_current_rain is not None:
-                    wll_packet.update(add_current_rain)
+                if self.api_parameters['udp_enable'] == 1:
+                    for s in data['conditions']:
+                        WLLSensorRegistry.decode(self.sensor_registry.udp, s['data_structure_type'], s, 'txid',
+                                                 wll_packet, rain_data)
+
+            rainFall_Daily = rain_data.get('rainFall_Daily')
+            rainRate = rain_data.get('rainRate')
+            rainSize = rain_data.get('rainSize')
 
-                if len(self.dict_device_id) > 1:
-                    if extraTemp is not None:
-                        wll_packet.update(extraTemp)
+            logdbg("rainFall_Daily set : {}".format(rainFall_Daily))
 
-                    if extraHumid is not None:
-                        wll_packet.update(extraHumid)
+            rain_timestamp = wll_packet['dateTime']
 
-                for _health_packet in self.check_health_api(time.time()):
-                    wll_packet.update(_health_packet)
+            if rain_timestamp is None:
+                rain_timestamp = self.now()
 
-                if wll_packet['dateTime'] is not None:
-                    _packet = copy.copy(wll_packet)
+            rain, rainRate = self.calculate_rain(rainFall_Daily, rainRate, rainSize, rain_timestamp, type_of_packet)
 
-                logdbg("Current conditions Weewx packet : {}".format(_packet))
+            if rain is not None and rainRate is not None:
+                wll_packet['rain'] = rain
+                wll_packet['rainRate'] = rainRate
 
-            if type_of_packet == 'realtime_broadcast':
-                if add_current_rain is not None:
-                    udp_wll_packet.update(add_current_rain)
+            if type_of_packet == 'current_conditions':
+                if self.replay_time is None:
+                    with self.tracer.span('health_merge'):
+                        for _health_packet in self.check_health_api(time.time()):
+                            wll_packet.update(_health_packet)
+
+                if self.derived is not None:
+                    wll_packet.update(self.derived.calculate(wll_packet))
 
-                logdbg("Realtime broadcast Weewx packet : {}".format(udp_wll_packet))
+                logdbg("Current conditions Weewx packet : {}".format(wll_packet))
+
+            if type_of_packet == 'realtime_broadcast':
+                logdbg("Realtime broadcast Weewx packet : {}".format(wll_packet))
 
-                if udp_wll_packet['dateTime'] is not None:
-                    _packet = copy.copy(udp_wll_packet)
+            if wll_packet['dateTime'] is not None:
+                _packet = wll_packet
 
-            before_time = time.time() - 120
-            after_time = time.time() + 120
+            before_time = self.now() - 120
+            after_time = self.now() + 120
 
             if _packet is not None and _packet['dateTime'] is not None and before_time <= _packet[
                 'dateTime'] and after_time >= _packet['dateTime']:
@@ -615,6 +1965,15 @@ class WLLDriverAPI():
         except IndexError as error:
             raise weewx.WeeWxIOError('Structure type is not valid. Error is : {}'.format(error))
 
+    def now(self):
+
+        # Time of the input when replaying a record file
+
+        if self.replay_time is not None:
+            return self.replay_time
+
+        return time.time()
+
     def WLAPIv2(self, start_timestamp, end_timestamp):
 
         parameters = {
@@ -655,8 +2014,7 @@ class WLLDriverAPI():
             logdbg("Request health conditions into current_conditions for "
                    "timestamp : {}".format(self.health_timestamp_archive))
 
-            for _health_packet in self.request_health_wl(self.health_timestamp_archive -
-                                                         (self.api_parameters['wl_archive_interval'] * 60),
+            for _health_packet in self.request_health_wl(self.health_timestamp_archive - self.wl_archive_seconds,
                                                          self.health_timestamp_archive):
                 logdbg("Health conditions packet received : {}".format(_health_packet))
                 if _health_packet is not None:
@@ -673,7 +2031,7 @@ class WLLDriverAPI():
         # Set time of HealthAPI for future request
         if not self.check_health_time:
             current_time = time.time()
-            self.health_timestamp_archive = self.round_minutes(current_time, 'up', 15)
+            self.health_timestamp_archive = align_up(current_time, 900)
             self.check_health_time = True
             logdbg("Set future time request health API to {}".format(self.health_timestamp_archive))
 
@@ -725,36 +2083,129 @@ class WLLDriverAPI():
                 if _packet is not None:
                     yield _packet
 
+    def decode_wll(self, data, type_of_packet):
+
+        # Decode inside tracer and profiler, decoder yield only one packet
+
+        self.tracer.profile_start()
+
+        try:
+            with self.tracer.span('decode'):
+                packets = list(self.data_decode_wll(data, type_of_packet))
+        finally:
+            self.tracer.profile_stop()
+
+        return packets
+
     def request_wll(self, type_of_packet):
 
+        self.tracer.start_packet()
+
         if type_of_packet == 'current_conditions':
 
-            wll_packet = self.request_json_data(self.url_current_conditions, self.api_parameters['time_out'],
-                                                type_of_packet)
+            if self.cache_proxy is not None:
+                # Poll under the lock of the cache proxy, so the WLL is never requested by a client at the same time
+                with self.cache_proxy.fetch_lock:
+                    wll_packet = self.request_current_conditions()
+
+                    if wll_packet is not None:
+                        self.cache_proxy.store(wll_packet)
+            else:
+                wll_packet = self.request_current_conditions()
 
-            for _packet in self.data_decode_wll(wll_packet, type_of_packet):
+            for _packet in self.decode_wll(wll_packet, type_of_packet):
                 if _packet is not None:
-                    yield _packet
+                    self.sink_packet(_packet)
+                    self.tracer.yield_packet(_packet, type_of_packet)
+                    with self.tracer.span('yield'):
+                        yield _packet
+                    self.tracer.end_packet()
 
         if type_of_packet == 'realtime_broadcast':
             data_broadcast = self.get_realtime_broadcast()
 
             if data_broadcast is not None:
-                for _packet in self.data_decode_wll(data_broadcast, type_of_packet):
+                for _packet in self.decode_wll(data_broadcast, type_of_packet):
                     if _packet is not None:
-                        yield _packet
+                        self.sink_packet(_packet)
+                        self.tracer.yield_packet(_packet, type_of_packet)
+                        with self.tracer.span('yield'):
+                            yield _packet
+                        self.tracer.end_packet()
+
+    def sink_packet(self, packet):
+
+        # Give each decoded packet to the columnar store and the shared ring buffer
+
+        if self.columnar_store is not None:
+            self.columnar_store.append(packet)
+
+        if self.shared_ring is not None:
+            self.shared_ring.publish(packet)
+
+    def close(self):
+
+        # Flush what is still buffered before Weewx stop
+
+        if self.columnar_store is not None:
+            self.columnar_store.close()
+
+        if self.shared_ring is not None:
+            self.shared_ring.close()
+
+        if self.cache_proxy is not None:
+            self.cache_proxy.close()
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+        if self.comsocket is not None:
+            self.comsocket.close()
+
+    def get_udp_socket(self):
+
+        # Create socket for udp broadcast
+
+        if self.comsocket is None:
+            udp_socket = socket(AF_INET, SOCK_DGRAM)
+
+            try:
+                udp_socket.bind(('0.0.0.0', 22222))
+            except OSError as error:
+                udp_socket.close()
+                raise weewx.WeeWxIOError('Unable to listen realtime broadcast on port 22222 : {}'.format(error))
+
+            udp_socket.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+            self.comsocket = udp_socket
+
+            # Don't wait forever on UDP socket if sources can fail over
+            if self.api_parameters['failover_enable'] == 1:
+                self.comsocket.settimeout(self.api_parameters['time_out'])
+
+        return self.comsocket
 
     def request_realtime_broadcast(self):
 
-        poll_interval = self.api_parameters['poll_interval']
+        self.get_udp_socket()
+        self.renew_realtime_broadcast(self.api_parameters['poll_interval'])
 
-        if self.udp_countdown - poll_interval < time.time():
-            rb = self.request_json_data(self.url_realtime_broadcast, self.api_parameters['time_out'],
-                                        'Realtime_broadcast')
+    def renew_realtime_broadcast(self, min_remaining):
 
-            if rb['data'] is not None:
-                self.udp_countdown = time.time() + rb['data']['duration']
-                return
+        # Renew broadcast if it stops in less than min_remaining, concurrent renewals from the cache proxy
+        # wait for the same request. Return the remaining time of broadcast.
+
+        # A renewal lasts realtime_duration, a longer min_remaining from a client would renew at each request
+        min_remaining = min(min_remaining, self.realtime_duration / 2)
+
+        with self.realtime_lock:
+            if self.udp_countdown - min_remaining < time.time():
+                rb = self.request_json_data(self.url_realtime_broadcast, self.api_parameters['time_out'],
+                                            'Realtime_broadcast')
+
+                if rb['data'] is not None:
+                    self.udp_countdown = time.time() + rb['data']['duration']
+
+            return max(self.udp_countdown - time.time(), 0)
 
     def get_realtime_broadcast(self):
 
@@ -762,8 +2213,13 @@ class WLLDriverAPI():
 
         if self.udp_countdown - poll_interval > time.time():
             try:
-                data, wherefrom = comsocket.recvfrom(2048)
-                realtime_data = json.loads(data.decode("utf-8"))
+                with self.tracer.span('udp_wait'):
+                    data, wherefrom = self.get_udp_socket().recvfrom(2048)
+                if self.recorder is not None:
+                    self.recorder.record('realtime_broadcast', data)
+
+                with self.tracer.span('json_parse'):
+                    realtime_data = json.loads(data.decode("utf-8"))
 
                 if realtime_data is not None:
                     return realtime_data
@@ -805,6 +2261,35 @@ class WLLDriver(weewx.drivers.AbstractDevice):
         api_parameters['wl_stationid'] = (stn_dict.get('wl_stationid', "ABCABC"))
         api_parameters['wl_archive_interval'] = int(stn_dict.get('wl_archive_interval', 15))
         api_parameters['device_id'] = (stn_dict.get('device_id', str("1:iss")))
+        api_parameters['columnar_enable'] = int(stn_dict.get('columnar_enable', 0))
+        api_parameters['columnar_path'] = (stn_dict.get('columnar_path', "/var/lib/weewx/wll_columnar"))
+        api_parameters['columnar_chunk_size'] = int(stn_dict.get('columnar_chunk_size', 4096))
+        api_parameters['columnar_flush_interval'] = int(stn_dict.get('columnar_flush_interval', 300))
+        api_parameters['rain_state_file'] = (stn_dict.get('rain_state_file', "/var/lib/weewx/wll_rain.json"))
+        api_parameters['shm_path'] = (stn_dict.get('shm_path', ""))
+        api_parameters['shm_slots'] = int(stn_dict.get('shm_slots', 256))
+        api_parameters['shm_slot_size'] = int(stn_dict.get('shm_slot_size', 2048))
+        api_parameters['proxy_host'] = (stn_dict.get('proxy_host', "127.0.0.1"))
+        api_parameters['proxy_port'] = int(stn_dict.get('proxy_port', 0))
+        api_parameters['proxy_max_age'] = int(stn_dict.get('proxy_max_age', api_parameters['poll_interval'] +
+                                                            api_parameters['time_out']))
+        api_parameters['failover_enable'] = int(stn_dict.get('failover_enable', 0))
+        api_parameters['breaker_failures'] = int(stn_dict.get('breaker_failures', 3))
+        api_parameters['breaker_reset'] = int(stn_dict.get('breaker_reset', 60))
+        api_parameters['record_file'] = (stn_dict.get('record_file', ""))
+        api_parameters['derived_enable'] = int(stn_dict.get('derived_enable', 0))
+        api_parameters['trace_file'] = (stn_dict.get('trace_file', ""))
+        api_parameters['trace_sample'] = int(stn_dict.get('trace_sample', 100))
+        api_parameters['profile_file'] = (stn_dict.get('profile_file', ""))
+        api_parameters['profile_every'] = int(stn_dict.get('profile_every', 1000))
+        api_parameters['coalesce_interval'] = float(stn_dict.get('coalesce_interval', 0))
+        api_parameters['dedup_history'] = int(stn_dict.get('dedup_history', 64))
+        api_parameters['reorder_window'] = float(stn_dict.get('reorder_window', 0))
+
+        for name in ('shm_slots', 'profile_every'):
+            if api_parameters[name] <= 0:
+                raise weewx.ViolatedPrecondition("{} must be greater than 0, got {}".format(name,
+                                                                                         api_parameters[name]))
 
         self.poll_interval = api_parameters['poll_interval']
         self.max_tries = api_parameters['max_tries']
@@ -812,10 +2297,36 @@ class WLLDriver(weewx.drivers.AbstractDevice):
         self.udp_enable = api_parameters['udp_enable']
         self.ntries = 1
 
+        # Records of Weatherlink.com only match the Weewx archive with the same interval
+
+        archive_interval = stn_dict.get('StdArchive', {}).get('archive_interval')
+        if archive_interval is not None and int(archive_interval) != api_parameters['wl_archive_interval'] * 60:
+            loginf("archive_interval of Weewx (%s s) is not wl_archive_interval (%s min)" %
+                   (archive_interval, api_parameters['wl_archive_interval']))
+
         # Define WLLDriverAPI
 
         self.WLLDriverAPI = WLLDriverAPI(api_parameters)
 
+        # Define filter of duplicate and out-of-order packets
+
+        self.packet_filter = WLLPacketFilter(api_parameters['dedup_history'], api_parameters['reorder_window'])
+
+        # Define coalescer of loop packets
+
+        self.coalescer = None
+        if api_parameters['coalesce_interval'] > 0:
+            self.coalescer = WLLCoalescer(api_parameters['coalesce_interval'])
+
+        # Define circuit breakers of sources
+
+        self.failover_enable = api_parameters['failover_enable']
+        self.breakers = {}
+        for source in ('WLL HTTP', 'UDP stream', 'Weatherlink.com'):
+            self.breakers[source] = WLLCircuitBreaker(source, api_parameters['breaker_failures'],
+                                                      api_parameters['breaker_reset'])
+        self.last_cloud_timestamp = None
+
         # Show description at startup of Weewx
 
         loginf("driver is %s" % DRIVER_NAME)
@@ -831,6 +2342,48 @@ class WLLDriver(weewx.drivers.AbstractDevice):
 
         return self.model
 
+    def closePort(self):
+
+        # Called by Weewx at shutdown
+
+        self.WLLDriverAPI.close()
+
+        # Packets still held by the filter and the coalescer can't be sent anymore, log them so lost rain is known
+
+        dropped = self.packet_filter.pop_ready(flush=True)
+        if self.coalescer is not None:
+            _coalesced_packet = self.coalescer.pop_ready(flush=True)
+            if _coalesced_packet is not None:
+                dropped.append(_coalesced_packet)
+
+        if dropped:
+            rain = sum(_packet['rain'] for _packet in dropped if _packet.get('rain') is not None)
+            loginf("{} packets held by the filter and the coalescer dropped at shutdown, with {} of rain".format(
+                len(dropped), rain))
+
+        loginf("Packets filter : {}".format(self.packet_filter.stats()))
+
+        if self.failover_enable == 1:
+            for source, breaker in self.breakers.items():
+                loginf("Circuit {} : {}".format(source, breaker.stats()))
+
+    def send_packets(self, packets):
+
+        # Pass packets released by the filter through the coalescer
+
+        for _packet in packets:
+            if self.coalescer is None:
+                yield _packet
+            else:
+                _coalesced_packet = self.coalescer.add(_packet)
+                if _coalesced_packet is not None:
+                    yield _coalesced_packet
+
+        if self.coalescer is not None:
+            _coalesced_packet = self.coalescer.pop_ready()
+            if _coalesced_packet is not None:
+                yield _coalesced_packet
+
     def genStartupRecords(self, good_stamp):
 
         # Generate values since good stamp in Weewx database
@@ -843,6 +2396,13 @@ class WLLDriver(weewx.drivers.AbstractDevice):
 
                 if good_stamp is not None and (good_stamp + 60 < now_timestamp_wl):
                     for _packet_wl in self.WLLDriverAPI.request_wl(good_stamp, now_timestamp_wl):
+                        if self.packet_filter.is_duplicate('Weatherlink.com', _packet_wl['dateTime']):
+                            self.packet_filter.suppressed += 1
+                            logdbg("Duplicate archive record suppressed for timestamp : {}".format(
+                                _packet_wl['dateTime']))
+                            continue
+
+                        self.WLLDriverAPI.rain_ledger.set_backfill_end(_packet_wl['dateTime'])
                         yield _packet_wl
                         good_stamp = time.time() + 0.5
                         self.ntries = 1
@@ -858,15 +2418,55 @@ class WLLDriver(weewx.drivers.AbstractDevice):
         else:
             return
 
+    def genArchiveRecords(self, lastgood_ts):
+
+        # Generate archive records from Weatherlink.com when record_generation = hardware is set in [StdArchive].
+        # Called by Weewx at the end of each archive interval : yield records already on Weatherlink.com since
+        # lastgood_ts without waiting, an interval not yet archived is sent on the next call because lastgood_ts
+        # stays before it.
+
+        archive_seconds = self.WLLDriverAPI.wl_archive_seconds
+        closed_timestamp = align_down(time.time(), archive_seconds)
+
+        if lastgood_ts is None:
+            lastgood_ts = closed_timestamp - archive_seconds
+
+        if closed_timestamp <= lastgood_ts:
+            return
+
+        try:
+            records = [_record for _record in self.WLLDriverAPI.request_wl(lastgood_ts, closed_timestamp)
+                       if _record['dateTime'] > lastgood_ts]
+
+        except weewx.WeeWxIOError as e:
+            logerr("Failed to get archive records in genArchiveRecords: %s" % e)
+            return
+
+        for _record in records:
+            # Stop at the first interval without values, not only dateTime, usUnits and interval, so no
+            # interval is skipped
+            if len(_record) <= 3:
+                logdbg("Archive of {} not yet on Weatherlink.com, sent on next interval".format(_record['dateTime']))
+                return
+
+            logdbg("Archive record from Weatherlink.com : {}".format(_record))
+            yield _record
+
     def genLoopPackets(self):
 
         # Make loop packet specify by user by poll interval
 
+        if self.failover_enable == 1:
+            for _packet in self.genLoopPacketsFailover():
+                yield _packet
+            return
+
         while self.ntries < self.max_tries:
 
             try:
                 for _packet_wll in self.WLLDriverAPI.request_wll('current_conditions'):
-                    yield _packet_wll
+                    for _packet in self.send_packets(self.packet_filter.push('current_conditions', _packet_wll)):
+                        yield _packet
                     self.ntries = 1
 
                 if self.udp_enable == 0:
@@ -880,9 +2480,14 @@ class WLLDriver(weewx.drivers.AbstractDevice):
 
                     while time.time() < timeout_udp_broadcast:
                         for _realtime_packet in self.WLLDriverAPI.request_wll('realtime_broadcast'):
-                            yield _realtime_packet
+                            for _packet in self.send_packets(self.packet_filter.push('realtime_broadcast',
+                                                                                      _realtime_packet)):
+                                yield _packet
                             self.ntries = 1
 
+                        for _packet in self.send_packets(self.packet_filter.pop_ready()):
+                            yield _packet
+
             except weewx.WeeWxIOError as e:
                 logerr("Failed attempt %d of %d to get loop data in genLoopPackets: %s" %
                        (self.ntries, self.max_tries, e))
@@ -893,6 +2498,133 @@ class WLLDriver(weewx.drivers.AbstractDevice):
             logerr(msg)
             raise weewx.RetriesExceeded(msg)
 
+    def genLoopPacketsFailover(self):
+
+        # Same loop than genLoopPackets, but a source which is down is skipped until its circuit is probed
+        # again, and the last archive of Weatherlink.com is used while the WLL doesn't answer.
+        # RetriesExceeded is raised only if no source gives data max_tries times in a row.
+
+        while self.ntries < self.max_tries:
+            packets_sent = 0
+            breaker_http = self.breakers['WLL HTTP']
+            breaker_udp = self.breakers['UDP stream']
+
+            if breaker_http.allow_request():
+                try:
+                    for _packet_wll in self.WLLDriverAPI.request_wll('current_conditions'):
+                        for _packet in self.send_packets(self.packet_filter.push('current_conditions', _packet_wll)):
+                            yield _packet
+                        packets_sent += 1
+
+                    breaker_http.record_success()
+
+                except weewx.WeeWxIOError as e:
+                    logerr("Failed to get current conditions in genLoopPackets: %s" % e)
+                    breaker_http.record_failure()
+
+            if breaker_http.is_open():
+                for _packet in self.get_cloud_fallback():
+                    yield _packet
+                    packets_sent += 1
+
+            timeout_udp_broadcast = time.time() + self.poll_interval
+
+            if self.udp_enable == 1 and breaker_udp.allow_request():
+                # The WLL keeps broadcasting until the end of the last renewal, so UDP is still read while
+                # the circuit of WLL HTTP is open. Only the renewal needs HTTP.
+                if not breaker_http.is_open():
+                    try:
+                        self.WLLDriverAPI.request_realtime_broadcast()
+
+                    except weewx.WeeWxIOError as e:
+                        logerr("Failed to renew realtime broadcast in genLoopPackets: %s" % e)
+                        breaker_http.record_failure()
+
+                while time.time() < timeout_udp_broadcast and breaker_udp.allow_request():
+                    received = 0
+
+                    try:
+                        for _realtime_packet in self.WLLDriverAPI.request_wll('realtime_broadcast'):
+                            for _packet in self.send_packets(self.packet_filter.push('realtime_broadcast',
+                                                                                      _realtime_packet)):
+                                yield _packet
+                            received += 1
+
+                    except weewx.WeeWxIOError as e:
+                        logerr("Failed to decode realtime broadcast in genLoopPackets: %s" % e)
+
+                    if received > 0:
+                        breaker_udp.record_success()
+                        packets_sent += received
+                    else:
+                        breaker_udp.record_failure()
+
+                    for _packet in self.send_packets(self.packet_filter.pop_ready()):
+                        yield _packet
+
+            # Weatherlink.com gives a new archive only each archive interval, it is alive if it answered
+            cloud_alive = breaker_http.is_open() and self.breakers['Weatherlink.com'].state == 'closed' and \
+                self.last_cloud_timestamp is not None
+
+            if packets_sent > 0 or cloud_alive:
+                self.ntries = 1
+            else:
+                logerr("No source gave data, attempt %d of %d in genLoopPackets" % (self.ntries, self.max_tries))
+                self.ntries += 1
+
+            remaining = timeout_udp_broadcast - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+        else:
+            msg = "Max retries (%d) exceeded for LOOP data" % self.max_tries
+            logerr(msg)
+            raise weewx.RetriesExceeded(msg)
+
+    def get_cloud_fallback(self):
+
+        # Send the last archive of Weatherlink.com as loop packet, stamped now. Rain is removed because the
+        # rain ledger will count it when the WLL answers again.
+
+        breaker_cloud = self.breakers['Weatherlink.com']
+        now_timestamp_wl = self.WLLDriverAPI.get_timestamp_wl_archive()
+
+        if self.last_cloud_timestamp is not None and now_timestamp_wl <= self.last_cloud_timestamp:
+            return
+
+        if not breaker_cloud.allow_request():
+            return
+
+        try:
+            _newest_wl = None
+
+            for _packet_wl in self.WLLDriverAPI.request_wl(now_timestamp_wl - self.WLLDriverAPI.wl_archive_seconds,
+                                                            now_timestamp_wl):
+                # Keep only the newest record with values, the archive of the interval may not be on
+                # Weatherlink.com yet
+                if set(_packet_wl) - {'interval', 'rain', 'dateTime', 'usUnits'} and \
+                        (_newest_wl is None or _packet_wl['dateTime'] > _newest_wl['dateTime']):
+                    _newest_wl = _packet_wl
+
+            if _newest_wl is not None and (self.last_cloud_timestamp is None or
+                                           _newest_wl['dateTime'] > self.last_cloud_timestamp):
+                _packet = copy.copy(_newest_wl)
+                for key in ('interval', 'rain', 'dateTime', 'usUnits'):
+                    _packet.pop(key, None)
+
+                self.last_cloud_timestamp = _newest_wl['dateTime']
+                _packet['dateTime'] = int(time.time())
+                _packet['usUnits'] = _newest_wl['usUnits']
+                logdbg("Fallback packet from Weatherlink.com : {}".format(_packet))
+
+                for _packet_sent in self.send_packets(self.packet_filter.push('Weatherlink.com', _packet)):
+                    yield _packet_sent
+
+            breaker_cloud.record_success()
+
+        except weewx.WeeWxIOError as e:
+            logerr("Failed to get fallback data from Weatherlink.com: %s" % e)
+            breaker_cloud.record_failure()
+
 
 # ==============================================================================
 # Main program
@@ -920,11 +2652,20 @@ if __name__ == "__main__":
         parser = optparse.OptionParser(usage=usage)
         parser.add_option('--test-driver', dest='td', action='store_true',
                           help='test the driver')
+        parser.add_option('--replay', dest='replay', metavar='FILE',
+                          help='replay a record file made with record_file')
+        parser.add_option('--speed', dest='speed', type='float', default=0,
+                          help='speed of replay, 1 for real time, 0 for as fast as possible')
+        parser.add_option('--config', dest='config', metavar='FILE',
+                          help='weewx.conf to read [WLLDriver] from for replay')
         (options, args) = parser.parse_args()
 
         if options.td:
             test_driver()
 
+        if options.replay:
+            replay(options.replay, options.speed, options.config)
+
 
     def test_driver():
         import weeutil.weeutil
@@ -934,4 +2675,20 @@ if __name__ == "__main__":
             print((weeutil.weeutil.timestamp_to_string(pkt['dateTime']), pkt))
 
 
+    def replay(record_file, speed, config_file):
+        import weeutil.weeutil
+        stn_dict = {}
+        if config_file:
+            import configobj
+            stn_dict = dict(configobj.ConfigObj(config_file, file_error=True).get(DRIVER_NAME, {}))
+        else:
+            print("no --config given, replay with default [WLLDriver] values")
+        print("replay {} at speed {}".format(record_file, speed))
+        wll_replay = WLLReplay(stn_dict, record_file, speed)
+        for pkt in wll_replay.genPackets():
+            print((weeutil.weeutil.timestamp_to_string(pkt['dateTime']), pkt))
+        wll_replay.close()
+        print("{} inputs failed to decode".format(wll_replay.errors))
+
+
     main()